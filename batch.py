@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os.path import join, splitext
+from typing import Any, Dict, List, Tuple
+
+ANNOTATED_FOLDER = join('documents', 'annotated_decisions')
+TXT_FOLDER = join('documents', 'txt_files')
+MANIFEST_PATH = join('documents', 'batch_manifest.jsonl')
+PIPELINES = ('structured', 'plain')
+
+
+def list_decisions(folder: str, extension: str) -> List[str]:
+    if not os.path.isdir(folder):
+        return []
+    return sorted(splitext(name)[0] for name in os.listdir(folder) if name.endswith(extension))
+
+
+def discover_jobs(pipelines=PIPELINES) -> List[Tuple[str, str]]:
+    """Return (decision_number, pipeline) pairs for every decision found in the corpus."""
+    jobs = []
+    if 'structured' in pipelines:
+        jobs += [(decision, 'structured') for decision in list_decisions(ANNOTATED_FOLDER, '.json')]
+    if 'plain' in pipelines:
+        jobs += [(decision, 'plain') for decision in list_decisions(TXT_FOLDER, '.txt')]
+    return jobs
+
+
+def load_manifest(manifest_path: str) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """Read the manifest; the last record of a (decision, pipeline) pair wins."""
+    records = {}
+    if not os.path.exists(manifest_path):
+        return records
+    with open(manifest_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # half-written line from an interrupted run
+            records[(record['decision'], record['pipeline'])] = record
+    return records
+
+
+def append_manifest(manifest_path: str, record: Dict[str, Any]) -> None:
+    with open(manifest_path, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def init_worker(workers: int) -> None:
+    """The workers call the API at the same time, so each gets an equal share of the account's rate limits."""
+    from utils.rate_governor import share_default_governor
+    share_default_governor(workers)
+
+
+def run_job(decision_number: str, pipeline: str) -> Dict[str, Any]:
+    """Run one pipeline for one decision inside a worker process. Never raises."""
+    started = time.time()
+    record = {'decision': decision_number, 'pipeline': pipeline}
+    try:
+        if pipeline == 'structured':
+            import main
+            main.summarize_decision(decision_number)
+        else:
+            import plain_summary
+            plain_summary.summarize_large_text(
+                decision_number, plain_summary.INPUT_FOLDER, plain_summary.OUTPUT_FOLDER, plain_summary.PROMPT
+            )
+        record['status'] = 'done'
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = f'{type(e).__name__}: {e}'
+        record['traceback'] = traceback.format_exc()
+    record['elapsed'] = round(time.time() - started, 3)
+    return record
+
+
+def write_metrics_snapshot() -> None:
+    """Rebuild the Prometheus snapshot from the traces the worker processes appended."""
+    from utils import metrics
+    if not os.path.exists(join(metrics.METRICS_DIR, metrics.TRACE_FILE)):
+        return
+    totals = metrics.write_snapshot_from_traces().totals()
+    print(f"LLM usage so far: {int(totals['prompt_tokens'])} prompt + {int(totals['completion_tokens'])} completion tokens, "
+          f"${totals['cost']:.4f}")
+
+
+def run_batch(pipelines=PIPELINES, workers: int = None, manifest_path: str = MANIFEST_PATH, retry_failed: bool = True) -> Dict[str, int]:
+    manifest = load_manifest(manifest_path)
+    skip = {'done', 'failed'} if not retry_failed else {'done'}
+    jobs = [job for job in discover_jobs(pipelines) if manifest.get(job, {}).get('status') not in skip]
+    print(f'{len(jobs)} jobs pending ({len(manifest)} already in {manifest_path})')
+
+    counts = {'done': 0, 'failed': 0}
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(workers,)) as executor:
+        futures = {executor.submit(run_job, decision, pipeline): (decision, pipeline) for decision, pipeline in jobs}
+        for idx, future in enumerate(as_completed(futures), start=1):
+            decision, pipeline = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:  # the worker process itself died
+                record = {'decision': decision, 'pipeline': pipeline, 'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+            append_manifest(manifest_path, record)
+            counts[record['status']] += 1
+            print(f"[{idx}/{len(jobs)}] {decision} ({pipeline}): {record['status']}")
+
+    print(f"Batch finished: {counts['done']} done, {counts['failed']} failed")
+    write_metrics_snapshot()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize every decision of the corpus.')
+    parser.add_argument('--pipeline', choices=PIPELINES, action='append', help='pipelines to run (default: all)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPU count)')
+    parser.add_argument('--manifest', default=MANIFEST_PATH, help='path of the resumable manifest')
+    parser.add_argument('--skip-failed', action='store_true', help='do not retry decisions that failed in a previous run')
+    args = parser.parse_args()
+
+    run_batch(tuple(args.pipeline or PIPELINES), args.workers, args.manifest, retry_failed=not args.skip_failed)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,40 @@
 import json
 import re
 import math
-import tiktoken
-from openai import OpenAI
+import asyncio
+from functools import lru_cache
 from dotenv import load_dotenv
 from os import getenv, makedirs
-from typing import List, Dict, Any
+from typing import TYPE_CHECKING, List, Dict, Any, Tuple
 from os.path import join
+from utils.boilerplate import strip_sections
+from utils.chunking import TokenEstimator
+from utils.extractive import compress_sections
+from utils.span_index import SpanDecision, load_annotated_decision
+from utils.request_planner import PlannedRequest, plan_requests
+from utils.llm_cache import default_cache
+from utils.llm_client import chat_completion, chat_completion_async
+from utils.metrics import default_recorder
+from utils.normalizer import normalize_sections
+from utils.summary_writer import IncrementalSummaryWriter
+from utils.tree_reduce import reduce_summaries
+
+if TYPE_CHECKING:
+    from openai import OpenAI, AsyncOpenAI
+
+MAX_CONCURRENCY = 8  # Μέγιστος αριθμός ταυτόχρονων αιτημάτων προς το API
+STREAM = True  # Λήψη των απαντήσεων σε streaming, με μέτρηση time-to-first-token
+NORMALIZE = True  # Αφαίρεση της διάταξης του κειμένου (κενά, αλλαγές γραμμής, αραιογραμμένες λέξεις) πριν τη μέτρηση tokens
+STRIP_BOILERPLATE = True  # Αφαίρεση των τυποποιημένων παραγράφων που επαναλαμβάνονται σε πολλές αποφάσεις
+EXTRACTIVE_TOKEN_BUDGET = 8000  # Tokens της απόφασης που στέλνονται στο API μετά την εξαγωγική συμπίεση (None = χωρίς συμπίεση)
+OPENAI_TOKEN_LIMIT = 16385  # Μέγιστο όριο tokens για το μοντέλο
+SAFE_TOKEN_LIMIT = 10000  # Κρατάω περιθώριο για prompt
+REDUCE_GROUP_TOKENS = 4000  # Μέγεθος ομάδας περιλήψεων σε κάθε επίπεδο της ιεραρχικής σύνοψης
+PROMPT = (
+    "You are a legal expert specializing in public procurement law. Provide an analytical summary focusing on the interpretation of legal principles, avoiding direct citations of legal texts unless explicitly important. Emphasize theoretical aspects and implications rather than procedural details. The summary should be in Greek."
+)
+REDUCE_CONTENT = "Summarize this section concisely in Greek while keeping key legal principles."
+CONCLUSION_CONTENT = "Summarize the key legal principles and their broader implications, excluding procedural references unless necessary. The summary should be in Greek."
 
 
 def read_json_file(file_path: str) -> Dict[str, Any]:
@@ -14,132 +42,212 @@ def read_json_file(file_path: str) -> Dict[str, Any]:
         return json.load(json_file)
 
 
-class TokenEstimator:
-    def __init__(self, model: str = 'gpt-4') -> None:
-        self.encoding = tiktoken.encoding_for_model(model)
+def completion_request(text, temperature, prompt, content, max_tokens) -> Dict[str, Any]:
+    return {
+        'model': 'gpt-3.5-turbo',
+        'temperature': temperature,
+        'messages': [
+            {'role': 'system', 'content': prompt},
+            {'role': 'user', 'content': f'{content}:{text}'}
+        ],
+        'max_tokens': max_tokens,
+    }
 
-    def estimate(self, text: str) -> int:
-        return len(self.encoding.encode(text))
 
+def openai_completion(client: 'OpenAI', text, temperature, prompt, content, max_tokens=400):
+    return chat_completion(client, completion_request(text, temperature, prompt, content, max_tokens), stream=STREAM)
 
-def split_text_into_chunks(text, max_tokens, token_estimator):
-    """Σπάει το κείμενο σε τμήματα που δεν ξεπερνούν τα max_tokens."""
-    sentences = text.split(". ")
-    chunks, chunk, chunk_token_size = [], "", 0
 
-    for sentence in sentences:
-        sentence_tokens = token_estimator.estimate(sentence)
-        if chunk_token_size + sentence_tokens > max_tokens:
-            chunks.append(chunk.strip())
-            chunk, chunk_token_size = sentence + ". ", sentence_tokens
-        else:
-            chunk += sentence + ". "
-            chunk_token_size += sentence_tokens
+async def openai_completion_async(client: 'AsyncOpenAI', text, temperature, prompt, content, max_tokens=400):
+    return await chat_completion_async(client, completion_request(text, temperature, prompt, content, max_tokens), stream=STREAM)
 
-    if chunk:
-        chunks.append(chunk.strip())
-    return chunks
 
+def section_parameters(class_name: str) -> Tuple[float, str, int]:
+    """Επιστρέφει temperature, οδηγία και μέγιστα tokens περίληψης για την κατηγορία του τμήματος."""
+    max_section_summary_tokens = 700
+    my_temperature, my_content = 0.4, 'Summarize the interpretation of the following legal text in Greek, avoiding direct citations unless they are critical.'
+    #πολλά tokens=περισσότερη πληροφορία χαμηλό temperature=ακριβέστερη απόδοση
+    if class_name == 'law' or class_name == 'important':
+        my_content = "Provide an interpretation of the legal provisions, including key references only if they are critical. The summary should be in Greek."
+        my_temperature, my_content, max_section_summary_tokens = (
+            0.3, 'Provide a structured interpretation of the legal provisions mentioned, focusing on their implications and theoretical aspects. The summary should be in Greek.', 1000
+        )
+    elif class_name in ['admissibility', 'interpretation', 'previous-ruling', 'court-response']:
+        my_temperature = 0.4
+    elif class_name == 'overview':
+        my_temperature = 0.6
+    elif class_name in ['facts', 'court-ruling', 'court-response']:
+        max_section_summary_tokens = 900  
+        my_temperature = 0.5  
+        max_section_summary_tokens = 500  
+        my_temperature = 0.5
+        my_content = 'Summarize the key legal aspects without excessive case details and avoid direct legal citations unless necessary. The summary should be in Greek.'
+    elif class_name == 'party-claims':
+        my_temperature = 0.4
+    elif class_name == 'important':
+        my_temperature = 0.5 
+        my_temperature = 0.7
+        my_content = 'Provide a deeper interpretation of this section, including references to legal texts only if they are essential. The summary should be in Greek.'
+    return my_temperature, my_content, int(max_section_summary_tokens)
 
-def openai_completion(client: OpenAI, text, temperature, prompt, content, max_tokens=400):
-    response = client.chat.completions.create(
-        model='gpt-3.5-turbo',
-        temperature=temperature,
-        messages=[
-            {'role': 'system', 'content': prompt},
-            {'role': 'user', 'content': f'{content}:{text}'}
-        ],
+
+def summarize_sections(client: 'OpenAI', requests: List[PlannedRequest], prompt: str, writer: IncrementalSummaryWriter = None) -> List[str]:
+    """Περίληψη των τμημάτων της απόφασης ένα προς ένα, σύμφωνα με το πλάνο αιτημάτων."""
+    section_summaries = []
+    for idx, request in enumerate(requests, start=1):
+        print(f'Μέρος {idx} από {len(requests)}: {request.class_name}')
+        my_temperature, my_content, _ = section_parameters(request.class_name)
+        response = openai_completion(
+            client, request.text, my_temperature, prompt, my_content, request.max_tokens
+        )
+        section_summaries.append(response.choices[0].message.content)
+        if writer:
+            writer.add(idx - 1, section_summaries[-1])
+    return section_summaries
+
+
+async def summarize_sections_async(client: 'AsyncOpenAI', requests: List[PlannedRequest], prompt: str, max_concurrency: int = MAX_CONCURRENCY, writer: IncrementalSummaryWriter = None) -> List[str]:
+    """Περίληψη των τμημάτων ταυτόχρονα, με έως max_concurrency αιτήματα σε εξέλιξη.
+
+    Οι περιλήψεις επιστρέφονται (και γράφονται στον writer) με τη σειρά των τμημάτων στο έγγραφο.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def summarize_section(idx: int, request: PlannedRequest) -> str:
+        my_temperature, my_content, _ = section_parameters(request.class_name)
+        async with semaphore:
+            print(f'Μέρος {idx} από {len(requests)}: {request.class_name}')
+            response = await openai_completion_async(
+                client, request.text, my_temperature, prompt, my_content, request.max_tokens
+            )
+        section_summary = response.choices[0].message.content
+        if writer:
+            writer.add(idx - 1, section_summary)
+        return section_summary
+
+    # Το gather διατηρεί τη σειρά των τμημάτων ανεξάρτητα από τη σειρά ολοκλήρωσης
+    return await asyncio.gather(
+        *(summarize_section(idx, request) for idx, request in enumerate(requests, start=1))
     )
-    return response
 
 
-def main():
+def plan_decision(decision_number: str, token_estimator: TokenEstimator, extractive_budget: int = EXTRACTIVE_TOKEN_BUDGET, recorder=None) -> List[PlannedRequest]:
+    """Φόρτωση της απόφασης, αφαίρεση τυποποιημένων παραγράφων, εξαγωγική συμπίεση και πλάνο αιτημάτων για τα τμήματα."""
+    recorder = recorder or default_recorder()
+    with recorder.stage('load'):
+        annotation_mappings = read_json_file(join('documents', 'annotation_mappings.json'))
+        annotated_decision = load_annotated_decision(decision_number)
+        annotations = annotated_decision['annotations']
+        # Τα τμήματα αντιγράφονται, ώστε το αρχείο και το mmap του span index να κλείσουν αμέσως
+        sections = list(annotations)
+        if isinstance(annotations, SpanDecision):
+            annotations.close()
+    token_index = None
+    if NORMALIZE:
+        # Οι μετρήσεις tokens φυλάσσονται ανά απόφαση, ώστε ο επόμενος σχεδιασμός να μην ξαναμετρά τα ίδια κείμενα
+        with recorder.stage('normalize'):
+            sections, token_counts, token_index = normalize_sections(decision_number, sections, token_estimator.model)
+        token_estimator = token_index.estimator(token_estimator.model)
+        recorder.record_normalization(token_counts['tokens'], token_counts['normalized_tokens'])
+        print(f"Κανονικοποίηση: {token_counts['tokens']} -> {token_counts['normalized_tokens']} tokens "
+              f"({token_counts['tokens'] - token_counts['normalized_tokens']} λιγότερα)")
+    if STRIP_BOILERPLATE:
+        with recorder.stage('boilerplate'):
+            sections = strip_sections(decision_number, sections)
+    if extractive_budget:
+        # Κάθε τμήμα κρατά τις κεντρικότερες προτάσεις του, ανάλογα με τη σημασία της κατηγορίας του· τα τμήματα με σημασία 0 παραλείπονται
+        with recorder.stage('extractive'):
+            sections = compress_sections(sections, annotation_mappings, token_estimator, extractive_budget)
+        print(f"Εξαγωγική συμπίεση: {len(annotated_decision['annotations'])} -> {len(sections)} τμήματα")
+    # Μικρά διαδοχικά τμήματα ενώνονται σε ένα αίτημα και όσα δεν χωράνε στο context χωρίζονται
+    with recorder.stage('plan'):
+        requests = plan_requests(
+            sections, annotation_mappings, token_estimator, section_parameters, PROMPT, OPENAI_TOKEN_LIMIT
+        )
+    if token_index is not None:
+        token_index.save()
+    print(f"{len(sections)} τμήματα, {len(requests)} αιτήματα")
+    return requests
+
+
+def section_request(request: PlannedRequest) -> Dict[str, Any]:
+    my_temperature, my_content, _ = section_parameters(request.class_name)
+    return completion_request(request.text, my_temperature, PROMPT, my_content, request.max_tokens)
+
+
+def reduce_request(text: str) -> Dict[str, Any]:
+    return completion_request(text, 0.4, PROMPT, REDUCE_CONTENT, 800)
+
+
+def conclusion_request(merged_summary: str) -> Dict[str, Any]:
+    return completion_request(merged_summary, 0.4, PROMPT, CONCLUSION_CONTENT, 800)
+
+
+def write_summary(output_folder: str, decision_number: str, merged_summary: str, conclusion: str) -> str:
+    path = join(output_folder, f'{decision_number}.txt')
+    makedirs(output_folder, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(f"{merged_summary}\n\nΣυμπέρασμα:\n{conclusion}".strip())
+    return path
+
+
+@lru_cache(maxsize=None)
+def get_client() -> 'OpenAI':
+    """Ο client δημιουργείται μία φορά ανά διεργασία· το openai φορτώνεται μόνο όταν χρειαστεί."""
+    from openai import OpenAI
     load_dotenv(override=True)
-    OPENAI_KEY = getenv('OPENAI_KEY')
-    OPENAI_TOKEN_LIMIT = 16385  # Μέγιστο όριο tokens για το μοντέλο
-    SAFE_TOKEN_LIMIT = 10000  # Κρατάω περιθώριο για prompt
-    my_prompt = (
-        "You are a legal expert specializing in public procurement law. Provide an analytical summary focusing on the interpretation of legal principles, avoiding direct citations of legal texts unless explicitly important. Emphasize theoretical aspects and implications rather than procedural details. The summary should be in Greek."
-    )
-    annotation_mappings = read_json_file(join('documents', 'annotation_mappings.json'))
-    decision_number = 'ste_2325-2023'
-    annotated_decision = read_json_file(join('documents', 'annotated_decisions', f'{decision_number}.json'))
+    return OpenAI(api_key=getenv('OPENAI_KEY'))
+
+
+def summarize_decision(decision_number: str, use_async: bool = True, max_concurrency: int = MAX_CONCURRENCY, output_folder: str = 'documents/my_summaries', extractive_budget: int = EXTRACTIVE_TOKEN_BUDGET):
+    recorder = default_recorder()
+    recorder.set_labels(decision=decision_number, pipeline='structured')
     
-    client = OpenAI(api_key=OPENAI_KEY)
+    client = get_client()
     token_estimator = TokenEstimator()
-    merged_full_summary = ''
-    
-    for idx, section in enumerate(annotated_decision['annotations'], start=1):
-        class_name = section.get('name', 'other')
-        total_parts = len(annotated_decision['annotations'])
-        print(f'Μέρος {idx} από {total_parts}: {class_name}')
-        max_section_summary_tokens = 700
-        my_temperature, my_content = 0.4, 'Summarize the interpretation of the following legal text in Greek, avoiding direct citations unless they are critical.'
-        #πολλά tokens=περισσότερη πληροφορία χαμηλό temperature=ακριβέστερη απόδοση
-        if class_name == 'law' or class_name == 'important':
-            my_content = "Provide an interpretation of the legal provisions, including key references only if they are critical. The summary should be in Greek."
-            my_temperature, my_content, max_section_summary_tokens = (
-                0.3, 'Provide a structured interpretation of the legal provisions mentioned, focusing on their implications and theoretical aspects. The summary should be in Greek.', 1000
+    requests = plan_decision(decision_number, token_estimator, extractive_budget, recorder)
+    # Οι περιλήψεις των τμημάτων γράφονται μόλις ολοκληρωθούν, ώστε να μη χαθούν αν αποτύχει κάποιο επόμενο βήμα
+    writer = IncrementalSummaryWriter(join(output_folder, f'{decision_number}.partial.txt'))
+    with recorder.stage('sections', requests=len(requests)):
+        if use_async:
+            # Ο async client είναι δεμένος στο event loop, οπότε δημιουργείται σε κάθε asyncio.run
+            from openai import AsyncOpenAI
+            section_summaries = asyncio.run(
+                summarize_sections_async(AsyncOpenAI(api_key=client.api_key), requests, PROMPT, max_concurrency, writer)
             )
-        elif class_name in ['admissibility', 'interpretation', 'previous-ruling', 'court-response']:
-            my_temperature = 0.4
-        elif class_name == 'overview':
-            my_temperature = 0.6
-        elif class_name in ['facts', 'court-ruling', 'court-response']:
-            max_section_summary_tokens = 900  
-            my_temperature = 0.5  
-            max_section_summary_tokens = 500  
-            my_temperature = 0.5
-            my_content = 'Summarize the key legal aspects without excessive case details and avoid direct legal citations unless necessary. The summary should be in Greek.'
-        elif class_name == 'party-claims':
-            my_temperature = 0.4
-        elif class_name == 'important':
-            my_temperature = 0.5 
-            my_temperature = 0.7
-            my_content = 'Provide a deeper interpretation of this section, including references to legal texts only if they are essential. The summary should be in Greek.'
-        
-        response = openai_completion(
-            client, section['text'], my_temperature, my_prompt, my_content, int(max_section_summary_tokens)
-        )
-        merged_section_summary = response.choices[0].message.content
-        merged_full_summary += f' {merged_section_summary}'
+        else:
+            section_summaries = summarize_sections(client, requests, PROMPT, writer)
+    merged_full_summary = ''.join(f' {section_summary}' for section_summary in section_summaries)
     
-    # Περιορισμός μεγέθους κειμένου για αποφυγή OpenAI error
+    # Αν οι περιλήψεις ξεπερνούν το SAFE_TOKEN_LIMIT, συνοψίζονται ιεραρχικά (παράλληλα σε κάθε επίπεδο) χωρίς περικοπή
     merged_summary_tokens = token_estimator.estimate(merged_full_summary)
     if merged_summary_tokens > SAFE_TOKEN_LIMIT:
-        print(f'Προειδοποίηση: Το σύνολο της περίληψης ({merged_summary_tokens} tokens) είναι πολύ μεγάλο. Μειώνεται για αποφυγή σφάλματος.')
-        merged_full_summary = ' '.join(merged_full_summary.split()[:SAFE_TOKEN_LIMIT]) if merged_summary_tokens > SAFE_TOKEN_LIMIT else merged_full_summary
-    
-    # Αν το merged_full_summary είναι πολύ μεγάλο, το χωρίζω σε μικρότερα chunks
-    if merged_summary_tokens > SAFE_TOKEN_LIMIT:
-        print(f'Προειδοποίηση: Το σύνολο της περίληψης ({merged_summary_tokens} tokens) είναι πολύ μεγάλο. Χωρίζεται σε μικρότερα τμήματα για αποφυγή σφάλματος.')
-        chunks = split_text_into_chunks(merged_full_summary, 4000, token_estimator)
-        summarized_chunks = []
-        
-        for chunk in chunks:
-            chunk_summary = openai_completion(
-                client, chunk, 0.4, my_prompt,
-                "Summarize this section concisely in Greek while keeping key legal principles.",
-                800
-            )
-            summarized_chunks.append(chunk_summary.choices[0].message.content)
-        
-        merged_full_summary = ' '.join(summarized_chunks)
+        print(f'Προειδοποίηση: Το σύνολο της περίληψης ({merged_summary_tokens} tokens) είναι πολύ μεγάλο. Συνοψίζεται σε επίπεδα για αποφυγή σφάλματος.')
+
+        def summarize_chunk(chunk: str) -> str:
+            return chat_completion(client, reduce_request(chunk), stream=STREAM).choices[0].message.content
+
+        with recorder.stage('reduce'):
+            reduced_summaries = reduce_summaries(section_summaries, summarize_chunk, token_estimator, REDUCE_GROUP_TOKENS, SAFE_TOKEN_LIMIT, max_concurrency)
+        merged_full_summary = ' '.join(reduced_summaries)
     
     # Εισαγωγή γενικού συμπεράσματος
-    summary_conclusion = openai_completion(
-        client, merged_full_summary, 0.4, my_prompt,
-        "Summarize the key legal principles and their broader implications, excluding procedural references unless necessary. The summary should be in Greek.",
-        800
-    )
-    merged_full_summary += f"\n\nΣυμπέρασμα:\n{summary_conclusion.choices[0].message.content}"
+    with recorder.stage('conclusion'):
+        summary_conclusion = chat_completion(client, conclusion_request(merged_full_summary), stream=STREAM)
     
-    output_folder = 'documents/my_summaries'
-    makedirs(output_folder, exist_ok=True)
-    with open(join(output_folder, f'{decision_number}.txt'), 'w', encoding='utf-8') as file:
-        file.write(merged_full_summary.strip())
+    with recorder.stage('write'):
+        write_summary(output_folder, decision_number, merged_full_summary, summary_conclusion.choices[0].message.content)
+        writer.discard()
     
     print(f'Περίληψη αποθηκεύτηκε: {decision_number}.txt')
+    cache_stats = default_cache().stats()
+    print(f"Cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    print(f'Κόστος: {recorder.summary()} (μετρικές: {recorder.write_snapshot()})')
+
+
+def main(use_async: bool = True, max_concurrency: int = MAX_CONCURRENCY):
+    decision_number = 'ste_2325-2023'
+    summarize_decision(decision_number, use_async, max_concurrency)
 
 
 if __name__ == '__main__':
@@ -1,105 +1,143 @@
 import os
-from openai import OpenAI
+from functools import lru_cache
 from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-
-# Initialize OpenAI client
-OPENAI_KEY = os.getenv('OPENAI_KEY')
-client = OpenAI(api_key=OPENAI_KEY)
+from utils import chunking
+from utils.boilerplate import strip_boilerplate
+from utils.chunking import TokenEstimator
+from utils.llm_cache import default_cache
+from utils.llm_client import chat_completion
+from utils.metrics import default_recorder
+from utils.normalizer import normalize_decision_text
+from utils.summary_writer import IncrementalSummaryWriter
+from utils.tree_reduce import parallel_map, reduce_summaries
+
+INPUT_FOLDER = "documents/txt_files"
+OUTPUT_FOLDER = "documents/plain_summaries"
+NORMALIZE = True  # Collapse layout whitespace and line-break hyphenation before counting tokens
+STRIP_BOILERPLATE = True  # Drop the court formulas that recur across decisions before summarizing
+PROMPT = "You are a legal professional. Summarize the following legal text in a concise manner and in Greek language, keeping all key legal concepts."
+
+@lru_cache(maxsize=None)
+def get_client():
+    """OpenAI client, created on first use (importing openai takes most of a second)."""
+    from openai import OpenAI
+    # Load environment variables
+    load_dotenv()
+    return OpenAI(api_key=os.getenv('OPENAI_KEY'))
 
 def estimate_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
     """Estimate the number of tokens in the text."""
-    from tiktoken import encoding_for_model
-    encoding = encoding_for_model(model)
-    return len(encoding.encode(text))
+    return TokenEstimator(model).estimate(text)
 
 def split_text_into_chunks(text: str, max_tokens: int) -> list:
     """Split text into smaller chunks based on token limits."""
-    sentences = text.split(". ")
-    chunks, chunk, chunk_token_size = [], "", 0
-
-    for sentence in sentences:
-        sentence_tokens = estimate_tokens(sentence)
-        if chunk_token_size + sentence_tokens > max_tokens:
-            chunks.append(chunk.strip())
-            chunk, chunk_token_size = sentence + ". ", sentence_tokens
-        else:
-            chunk += sentence + ". "
-            chunk_token_size += sentence_tokens
-
-    if chunk:
-        chunks.append(chunk.strip())
-    return chunks
-
-def summarize_chunk(chunk: str, client, prompt: str, temperature: float, max_tokens: int) -> str:
-    """Summarize a single chunk using OpenAI."""
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        temperature=temperature,
-        messages=[
+    return chunking.split_text_into_chunks(text, max_tokens, TokenEstimator("gpt-3.5-turbo"))
+
+def chunk_request(chunk: str, prompt: str, temperature: float, max_tokens: int) -> dict:
+    """Chat completion request that summarizes a single chunk."""
+    return {
+        "model": "gpt-3.5-turbo",
+        "temperature": temperature,
+        "messages": [
             {"role": "system", "content": prompt},
             {"role": "user", "content": chunk}
         ],
-        max_tokens=max_tokens
-    )
+        "max_tokens": max_tokens
+    }
+
+def summarize_chunk(chunk: str, client, prompt: str, temperature: float, max_tokens: int, stream: bool = True) -> str:
+    """Summarize a single chunk using OpenAI."""
+    response = chat_completion(client, chunk_request(chunk, prompt, temperature, max_tokens), stream=stream)
     return response.choices[0].message.content
 
-def summarize_large_text(decision_number: str, input_folder: str, output_folder: str, prompt: str, temperature=0.7, max_chunk_tokens=2500, summary_tokens=700, max_total_tokens=13000):
-    # file paths
+def read_chunks(decision_number: str, input_folder: str, max_chunk_tokens: int, recorder=None) -> list:
+    """Read a decision, normalize its layout, strip its boilerplate and split it into chunks."""
     input_path = os.path.join(input_folder, f"{decision_number}.txt")
-    output_path = os.path.join(output_folder, f"{decision_number}.txt")
-
     # Ensure file exists
     if not os.path.exists(input_path):
         raise FileNotFoundError(f"The file {input_path} does not exist.")
 
+    recorder = recorder or default_recorder()
+    token_counts = None
+    if NORMALIZE:
+        # Token counts of the decision are kept in a sidecar index, so an unchanged file is not tokenized again
+        with recorder.stage("normalize"):
+            normalized, token_counts, _ = normalize_decision_text(decision_number, input_path, "gpt-3.5-turbo")
+        text = normalized.text
+        recorder.record_normalization(token_counts["tokens"], token_counts["normalized_tokens"])
+        print(f"Normalization: {token_counts['tokens']} -> {token_counts['normalized_tokens']} tokens "
+              f"({token_counts['tokens'] - token_counts['normalized_tokens']} saved)")
+    else:
+        with recorder.stage("read"):
+            with open(input_path, "r", encoding="utf-8") as file:
+                text = file.read()
+
+    # Paragraphs that recur almost verbatim in other decisions are not worth summarizing again
+    if STRIP_BOILERPLATE:
+        with recorder.stage("boilerplate"):
+            text = strip_boilerplate(decision_number, text)
+
+    # Split the text; a decision that fits in one chunk needs no tokenizing
+    with recorder.stage("chunking"):
+        if token_counts and token_counts["normalized_tokens"] <= max_chunk_tokens:
+            return [text.strip()] if text.strip() else []
+        return split_text_into_chunks(text, max_chunk_tokens)
+
+def summarize_large_text(decision_number: str, input_folder: str, output_folder: str, prompt: str, temperature=0.7, max_chunk_tokens=2500, summary_tokens=700, max_total_tokens=13000, max_workers=8):
+    output_path = os.path.join(output_folder, f"{decision_number}.txt")
+
+    recorder = default_recorder()
+    recorder.set_labels(decision=decision_number, pipeline="plain")
+    usage_before = recorder.metrics.totals()
+
+    chunks = read_chunks(decision_number, input_folder, max_chunk_tokens, recorder)
+
     # Create folder if not exist
     os.makedirs(output_folder, exist_ok=True)
 
-    with open(input_path, "r", encoding="utf-8") as file:
-        text = file.read()
-
-    # Split the text
-    chunks = split_text_into_chunks(text, max_chunk_tokens)
+    # Summarize all chunks in parallel. Every chunk summary is also appended to a partial file right away
+    writer = IncrementalSummaryWriter(os.path.join(output_folder, f"{decision_number}.partial.txt"))
 
-    # Summarize and combine
-    combined_summary = ""
-    total_tokens = 0
-    for idx, chunk in enumerate(chunks):
-        print(f"Summarizing chunk {idx + 1} of {len(chunks)}...")
+    client = get_client()
 
-        # Estimate the tokens limit
-        remaining_tokens = max_total_tokens - total_tokens
-        if remaining_tokens <= 0:
-            print("Token limit reached. Stopping summarization.")
-            break
+    def summarize(chunk: str) -> str:
+        return summarize_chunk(chunk, client, prompt, temperature, summary_tokens)
 
-        # Limit the summary tokens to the remaining allowed tokens
-        current_summary_tokens = min(summary_tokens, remaining_tokens)
-        summary = summarize_chunk(chunk, client, prompt, temperature, current_summary_tokens)
-        combined_summary += summary + "\n\n"
+    print(f"Summarizing {len(chunks)} chunks...")
+    summaries = []
+    with recorder.stage("chunks", requests=len(chunks)):
+        for summary in parallel_map(summarize, chunks, max_workers):
+            summaries.append(summary)
+            writer.append(summary)
 
-        # Update the total token count
-        total_tokens += estimate_tokens(summary)
+    # Summaries over the total token limit are reduced hierarchically instead of being dropped
+    token_estimator = TokenEstimator("gpt-3.5-turbo")
+    with recorder.stage("reduce"):
+        summaries = reduce_summaries(summaries, summarize, token_estimator, max_chunk_tokens, max_total_tokens, max_workers)
+    combined_summary = "".join(summary + "\n\n" for summary in summaries)
 
     # Save the combined summary to the output file
-    with open(output_path, "w", encoding="utf-8") as file:
-        file.write(combined_summary)
-
-    print(f"Summary saved to {output_path}. Total tokens used: {total_tokens}")
+    with recorder.stage("write"):
+        with open(output_path, "w", encoding="utf-8") as file:
+            file.write(combined_summary)
+        writer.discard()
+
+    # Token usage as reported by the API for the calls of this decision
+    usage_after = recorder.metrics.totals()
+    total_tokens = int(sum(usage_after[key] - usage_before[key] for key in ("prompt_tokens", "completion_tokens")))
+    cost = usage_after["cost"] - usage_before["cost"]
+    print(f"Summary saved to {output_path}. Total tokens used: {total_tokens} (${cost:.4f})")
+    cache_stats = default_cache().stats()
+    print(f"Cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    print(f"Metrics written to {recorder.write_snapshot()}")
     return combined_summary
 
 def main():
     decision_number = "ste_2325-2023"
-    input_folder = "documents/txt_files"
-    output_folder = "documents/plain_summaries"
-    prompt = "You are a legal professional. Summarize the following legal text in a concise manner and in Greek language, keeping all key legal concepts."
 
     try:
         # Summarize the large text file
-        summarize_large_text(decision_number, input_folder, output_folder, prompt)
+        summarize_large_text(decision_number, INPUT_FOLDER, OUTPUT_FOLDER, PROMPT)
 
     except FileNotFoundError as e:
         print(f"Error: {e}")
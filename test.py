@@ -2,6 +2,7 @@ import openai
 import json
 from typing import Dict, Any
 from os.path import join
+from utils.rate_governor import default_governor
 
 def read_json_file(file_path: str) -> Dict[str, Any]:
     with open(file_path, 'r', encoding='utf-8') as json_file:
@@ -40,7 +41,8 @@ def summarize_long_text(text, max_tokens=4096, section_length=3300):
 
     summaries = []
     for section in sections:
-        response = openai.chat.completions.create(
+        # Throttled to the account limits and retried on rate limits and server errors
+        response = default_governor().create(openai, dict(
             model="gpt-4",
             messages=[
                 {"role": "system", "content": "You are a legal professional. I will give you a part of a court decision. Answer in greek and use legal language"},
@@ -48,7 +50,7 @@ def summarize_long_text(text, max_tokens=4096, section_length=3300):
             ],
             max_tokens=min(max_tokens, 4050 - len(section)),  # Limit max_tokens per section
             temperature=0.7  # You can adjust the temperature based on your preference
-        )
+        ))
         summary = response.choices[0].message.content
         summaries.append(summary)
 
@@ -11,6 +11,16 @@ class TextAnnotationApp:
         
         self.parent_directory=os.path.abspath(os.getcwd())
 
+        # Annotations are kept in memory and every new one is appended to a journal file,
+        # together with the document it belongs to
+        self.annotations = []
+        self.journal_path = os.path.join(os.getcwd(), "annotations.journal.jsonl")
+        self.journal_file = None
+        self.file_path = None
+        self.annotated_path = None
+        self.recovered = {}  # document -> annotations from the journal, merged when that document is loaded
+        self.recover_journal()
+
         
         self.text_box = tk.Text(root, wrap="word", width=80, height=20)
         self.text_box.pack(side="left", expand=True, fill="both")
@@ -22,6 +32,9 @@ class TextAnnotationApp:
         self.load_file_button = tk.Button(root, text="Load Text from File", command=self.load_text_from_file)
         self.load_file_button.pack(pady=10)
 
+        self.load_annotated_button = tk.Button(root, text="Load Annotated Decision", command=self.load_annotated_decision)
+        self.load_annotated_button.pack(pady=10)
+
         self.annotation_button = tk.Button(root, text="Annotate Text", command=self.annotate_text)
         self.annotation_button.pack(pady=10)
 
@@ -66,9 +79,11 @@ class TextAnnotationApp:
         
         
     def load_text_from_file(self):
-        self.file_path = filedialog.askopenfilename(filetypes=[("Text Files", "*.txt")])
+        file_path = filedialog.askopenfilename(filetypes=[("Text Files", "*.txt")])
 
-        if self.file_path:
+        if file_path:
+            self.stash_annotations()
+            self.file_path = file_path
             # Open and read the text from the selected file. utf-8
             with open(self.file_path, "r", encoding="utf-8") as file:
                 text_content = file.read()
@@ -77,74 +92,197 @@ class TextAnnotationApp:
             self.text_box.delete("1.0", tk.END)
             self.text_box.insert(tk.END, text_content)
 
+            # Highlights of annotations recovered from the journal
+            self.annotated_path = None
+            self.annotations = self.merge_recovered([])
+            self.render_annotations(self.annotations)
+
+    def load_annotated_decision(self):
+        annotated_path = filedialog.askopenfilename(filetypes=[("Annotated Decisions", "*.json")])
+        if not annotated_path:
+            return
+        self.stash_annotations()
+        with open(annotated_path, "r", encoding="utf-8") as file:
+            data = json.load(file)
+        annotations = data.get("annotations", [])
+
+        # Offsets point into the original text file; older files only have the section texts
+        text_file = os.path.join(self.parent_directory, "documents", "txt_files", data.get("text_file", ""))
+        self.annotated_path = annotated_path
+        if data.get("text_file") and os.path.exists(text_file) and all("start" in annotation for annotation in annotations):
+            self.file_path = text_file
+            with open(text_file, "r", encoding="utf-8") as file:
+                text_content = file.read()
+        else:
+            self.file_path = None
+            parts, offset = [], 0
+            for annotation in annotations:
+                annotation["start"], annotation["end"] = offset, offset + len(annotation["text"])
+                parts.append(annotation["text"])
+                offset = annotation["end"] + 1
+            text_content = "\n".join(parts)
+
+        self.text_box.delete("1.0", tk.END)
+        self.text_box.insert(tk.END, text_content)
+        self.annotations = self.merge_recovered(annotations)
+        self.render_annotations(self.annotations)
+
+    def current_document(self):
+        # The text file, or the annotated decision when its text was rebuilt from the sections
+        if self.file_path:
+            return os.path.basename(self.file_path)
+        return os.path.basename(self.annotated_path) if self.annotated_path else ""
+
+    def stash_annotations(self):
+        # Unsaved annotations of the document being replaced come back when it is loaded again
+        document = self.current_document()
+        if document and self.annotations:
+            self.recovered.setdefault(document, []).extend(self.annotations)
+
+    def merge_recovered(self, annotations):
+        # Journal entries of this document that are not in the loaded annotations yet
+        recovered = self.recovered.pop(self.current_document(), []) if self.current_document() else []
+        known = {(a["class_id"], a.get("start"), a.get("end"), a["text"]) for a in annotations}
+        merged = list(annotations)
+        for annotation in recovered:
+            key = (annotation["class_id"], annotation.get("start"), annotation.get("end"), annotation["text"])
+            if key not in known:
+                known.add(key)
+                merged.append(annotation)
+        if recovered:
+            print(f"Merged {len(merged) - len(annotations)} recovered annotations into {self.current_document()}")
+        return merged
+
+    def render_annotations(self, annotations):
+        # One tag_add call per class with all of its ranges
+        ranges = {}
+        for annotation in annotations:
+            if "start" not in annotation:
+                continue
+            class_name = self.annotation_mappings.get(annotation["class_id"], {}).get("name", "other")
+            ranges.setdefault(class_name, []).extend(
+                (f"1.0 + {annotation['start']} chars", f"1.0 + {annotation['end']} chars")
+            )
+        for class_name, indices in ranges.items():
+            tag_name = f"{class_name}_tag"
+            self.text_box.tag_configure(tag_name, background=self.class_info[class_name]["color"])
+            self.text_box.tag_add(tag_name, *indices)
+
+    def char_offset(self, index):
+        # Number of characters between the start of the text and a Tk index
+        count = self.text_box.count("1.0", index, "chars")
+        return count[0] if count else 0
+
     def annotate_text(self):
-        selected_text = self.get_selected_text()
-        
+        selection = self.get_selection()
+
+        if selection:
+            start_index, end_index = selection
+            selected_text = self.text_box.get(start_index, end_index)
 
-        if selected_text:
             # Get the selected class
             selected_class_name = self.selected_class_var.get()
             selected_class_id = next(class_id for class_id, class_info in self.annotation_mappings.items() if class_info["name"] == selected_class_name
 )
 
 
-            # Save the annotation (dictionary)
-            annotation = {"class_id": selected_class_id, "text": selected_text}
-
-            # Temporary json annotation file in order to keep track of changes
-            annotations_path = os.path.join(os.getcwd(), "annotations.json")
-            try:
-                with open(annotations_path, "r", encoding="utf-8") as file:
-                    annotations = json.load(file)
-            except FileNotFoundError:
-                annotations = []
-
-            annotations.append(annotation)
-            
-            # Save annotations
-            with open(annotations_path, "w", encoding="utf-8") as file:
-                json.dump(annotations, file, indent=2)
+            # Save the annotation (dictionary). Offsets come from the selection itself
+            annotation = {
+                "class_id": selected_class_id,
+                "text": selected_text,
+                "start": self.char_offset(start_index),
+                "end": self.char_offset(end_index),
+            }
+            self.annotations.append(annotation)
+            self.append_to_journal(annotation)
 
             # background update
             tag_name = f"{selected_class_name}_tag"
             self.text_box.tag_configure(tag_name, background=self.class_info[selected_class_name]["color"])
-            start_index = self.text_box.search(selected_text, "1.0", stopindex=tk.END)
-            end_index = f"{start_index}+{len(selected_text)}c"
             self.text_box.tag_add(tag_name, start_index, end_index)
             self.text_box.tag_remove(tk.SEL, start_index, end_index)  # Remove selection
 
+    def get_selection(self):
+        # Get selected range
+        selection = self.text_box.tag_ranges(tk.SEL)
+        if selection:
+            return selection[0], selection[1]
+        else:
+            return None
+
     def get_selected_text(self):
         # Get selected text
-        start_index, end_index = self.text_box.tag_ranges(tk.SEL)
-        if start_index and end_index:
-            return self.text_box.get(start_index, end_index)
+        selection = self.get_selection()
+        if selection:
+            return self.text_box.get(*selection)
         else:
             return None
 
-    def save_annotations(self):
-        
-        # Get annotations
+    def append_to_journal(self, annotation):
+        # One JSON line per annotation, so a crash loses at most the line being written
+        if self.journal_file is None:
+            self.journal_file = open(self.journal_path, "a", encoding="utf-8")
+        self.journal_file.write(json.dumps({**annotation, "document": self.current_document()}, ensure_ascii=False) + "\n")
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+
+    def recover_journal(self):
+        # Replay the journal left behind by a session that was not saved
         try:
-            with open("annotations.json", "r", encoding="utf-8") as file:
-                annotations = json.load(file)
+            with open(self.journal_path, "rb") as file:
+                content = file.read()
         except FileNotFoundError:
-            annotations = []
+            return
+
+        # Drop a last line that was cut by the crash, so new entries start on a clean line
+        complete = content[:content.rfind(b"\n") + 1]
+        if len(complete) != len(content):
+            os.truncate(self.journal_path, len(complete))
+
+        count = 0
+        for line in complete.decode("utf-8").splitlines():
+            if line.strip():
+                annotation = json.loads(line)
+                # Entries of older journals have no document and are never merged automatically
+                self.recovered.setdefault(annotation.pop("document", ""), []).append(annotation)
+                count += 1
+        documents = ", ".join(document or "unknown document" for document in self.recovered)
+        print(f"Recovered {count} annotations of {documents} from {self.journal_path}")
+
+    def save_annotations(self):
 
         # Save to Json
         data = {"document_id": "...........",
+                "text_file": os.path.basename(self.file_path) if self.file_path else "",
                 "court": "ΣτΕ",
                 "legal_remedy":"..........",
                 "related_department": "...........",
-                "annotations": annotations}
+                "annotations": self.annotations}
         text_with_annotations_path = os.path.join(self.parent_directory, "documents", "annotated_decisions", "text_with_annotations.json")
-        with open(text_with_annotations_path, "w", encoding="utf-8") as file:
+        tmp_path = text_with_annotations_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
             json.dump(data, file, indent=2, ensure_ascii=False)
-        
-        try:
-            os.remove("annotations.json")
-        except FileNotFoundError:
-            pass  # File not found, nothing to delete
-              
+        os.replace(tmp_path, text_with_annotations_path)
+
+        # Annotations are safe in the final file; the journal keeps only those of other documents
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+        self.recovered.pop(self.current_document(), None)
+        if any(self.recovered.values()):
+            tmp_path = self.journal_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                for document, annotations in self.recovered.items():
+                    for annotation in annotations:
+                        file.write(json.dumps({**annotation, "document": document}, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.journal_path)
+        else:
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass  # File not found, nothing to delete
+        self.annotations = []
+
 
 if __name__ == "__main__":
     root = tk.Tk()
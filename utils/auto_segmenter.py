@@ -0,0 +1,285 @@
+"""Local pre-annotation of raw decisions with the classes of annotation_mappings.json.
+
+Every decision of documents/txt_files is split into its blank-line paragraphs and each
+paragraph gets a class, without any API call. The model is trained on the annotated
+decisions, whose sections are aligned to their text files (utils.span_index):
+
+- a multinomial naive Bayes over the words of the paragraph and a few structural cues
+  (relative position in the decision, first word, numbered paragraph, length), and
+- a transition matrix between the classes of consecutive paragraphs, because decisions
+  follow the same order (heading, overview, facts, ..., ruling); the most likely
+  sequence of classes is found with Viterbi.
+
+Consecutive paragraphs of the same class become one annotation. The output has the
+schema of the annotation tool, with text_file and character offsets, so the files of
+documents/auto_annotated open in utils/annotate_helper.py for review. Decisions are
+labelled in parallel, one process per core:
+
+    python -m utils.auto_segmenter              # every decision without output yet
+    python -m utils.auto_segmenter --evaluate   # leave-one-decision-out accuracy
+"""
+import argparse
+import json
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, splitext
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from utils.boilerplate import paragraph_spans
+from utils.lexical_metrics import tokenize
+from utils.span_index import align_sections
+
+ANNOTATED_FOLDER = join('documents', 'annotated_decisions')
+TXT_FOLDER = join('documents', 'txt_files')
+OUTPUT_FOLDER = join('documents', 'auto_annotated')
+MAPPINGS_PATH = join('documents', 'annotation_mappings.json')
+MODEL_PATH = join('.cache', 'auto_segmenter', 'model.npz')
+DEFAULT_CLASS = 'class0'  # text left out by the annotators
+POSITION_BUCKETS = 10
+SMOOTHING = 0.1  # additive smoothing of the word and transition counts
+WORD_WEIGHT = 32.0  # weight of the (length-normalized) words against the structural cues
+
+_NUMBERED = re.compile(r'\s*(\d+|[α-ω]{1,2})[.)]\s')
+
+
+def cue_features(text: str, start: int, length: int) -> List[str]:
+    """Structural features of a paragraph that starts at start in a text of length characters."""
+    words = tokenize(text)
+    features = [f'@position:{min(POSITION_BUCKETS - 1, start * POSITION_BUCKETS // max(length, 1))}',
+                f'@first:{words[0] if words else ""}',
+                f'@length:{min(4, len(words).bit_length() // 2)}']
+    if _NUMBERED.match(text):
+        features.append('@numbered')
+    return features
+
+
+def _class_of_paragraphs(text: str, paragraphs: Sequence[Tuple[int, int]], annotations: Sequence[Dict[str, Any]]) -> List[str]:
+    """Class of every paragraph: the annotated class that covers most of its characters."""
+    covered = np.zeros(len(text), dtype=np.int32)  # 0 = not annotated, k = k-th class id + 1
+    class_ids = sorted({annotation['class_id'] for annotation in annotations})
+    for annotation, span in zip(annotations, align_sections(text, [annotation['text'] for annotation in annotations])):
+        if span is not None:
+            covered[span[0]:span[1]] = class_ids.index(annotation['class_id']) + 1
+    labels = []
+    for start, end in paragraphs:
+        counts = np.bincount(covered[start:end], minlength=len(class_ids) + 1)
+        counts[0] = 0
+        labels.append(class_ids[counts.argmax() - 1] if counts.any() else DEFAULT_CLASS)
+    return labels
+
+
+def training_data(decisions: Sequence[str]) -> List[Tuple[List[Tuple[List[str], List[str]]], List[str]]]:
+    """(words and cues of every paragraph, class of every paragraph) of every annotated decision."""
+    documents = []
+    for decision_number in decisions:
+        with open(join(ANNOTATED_FOLDER, f'{decision_number}.json'), 'r', encoding='utf-8') as file:
+            annotations = json.load(file)['annotations']
+        with open(join(TXT_FOLDER, f'{decision_number}.txt'), 'r', encoding='utf-8') as file:
+            text = file.read()
+        paragraphs = paragraph_spans(text)
+        documents.append(([_paragraph_features(text, start, end) for start, end in paragraphs],
+                          _class_of_paragraphs(text, paragraphs, annotations)))
+    return documents
+
+
+def _paragraph_features(text: str, start: int, end: int) -> Tuple[List[str], List[str]]:
+    return tokenize(text[start:end]), cue_features(text[start:end], start, len(text))
+
+
+class Segmenter:
+    def __init__(self, class_ids: Sequence[str], vocabulary: Sequence[str], word_log_probs: np.ndarray,
+                 cue_log_probs: np.ndarray, log_start: np.ndarray, log_transitions: np.ndarray) -> None:
+        self.class_ids = list(class_ids)
+        self.vocabulary = {term: idx for idx, term in enumerate(vocabulary)}
+        self.word_log_probs = word_log_probs  # (vocabulary, classes); cues share the vocabulary
+        self.cue_log_probs = cue_log_probs
+        self.log_start = log_start
+        self.log_transitions = log_transitions  # (previous class, class)
+
+    @classmethod
+    def train(cls, documents, class_ids: Sequence[str]) -> 'Segmenter':
+        class_ids = list(class_ids)
+        vocabulary = sorted({term for paragraphs, _ in documents for words, cues in paragraphs for term in words + cues})
+        index = {term: idx for idx, term in enumerate(vocabulary)}
+        word_counts = np.zeros((len(vocabulary), len(class_ids)))
+        cue_counts = np.zeros((len(vocabulary), len(class_ids)))
+        start_counts = np.full(len(class_ids), SMOOTHING)
+        transition_counts = np.full((len(class_ids), len(class_ids)), SMOOTHING)
+        for paragraphs, labels in documents:
+            label_idx = [class_ids.index(label) for label in labels]
+            for (words, cues), label in zip(paragraphs, label_idx):
+                np.add.at(word_counts[:, label], np.array([index[word] for word in words], dtype=np.int64), 1)
+                np.add.at(cue_counts[:, label], np.array([index[cue] for cue in cues], dtype=np.int64), 1)
+            if label_idx:
+                start_counts[label_idx[0]] += 1
+                np.add.at(transition_counts, (label_idx[:-1], label_idx[1:]), 1)
+
+        def log_probs(counts: np.ndarray) -> np.ndarray:
+            counts = counts + SMOOTHING
+            return np.log(counts / counts.sum(axis=0))
+
+        return cls(class_ids, vocabulary, log_probs(word_counts), log_probs(cue_counts),
+                   np.log(start_counts / start_counts.sum()),
+                   np.log(transition_counts / transition_counts.sum(axis=1, keepdims=True)))
+
+    def emission_scores(self, paragraphs: Sequence[Tuple[List[str], List[str]]]) -> np.ndarray:
+        """(paragraphs, classes) log scores; word scores are averaged so long paragraphs do not drown the cues."""
+        scores = np.zeros((len(paragraphs), len(self.class_ids)))
+        for row, (words, cues) in enumerate(paragraphs):
+            word_idx = [self.vocabulary[word] for word in words if word in self.vocabulary]
+            cue_idx = [self.vocabulary[cue] for cue in cues if cue in self.vocabulary]
+            if word_idx:
+                scores[row] += WORD_WEIGHT * self.word_log_probs[word_idx].mean(axis=0)
+            scores[row] += self.cue_log_probs[cue_idx].sum(axis=0)
+        return scores
+
+    def predict(self, paragraphs: Sequence[Tuple[List[str], List[str]]]) -> List[str]:
+        """Most likely class sequence (Viterbi)."""
+        if not paragraphs:
+            return []
+        emissions = self.emission_scores(paragraphs)
+        scores = self.log_start + emissions[0]
+        backpointers = np.zeros(emissions.shape, dtype=np.int64)
+        for row in range(1, len(emissions)):
+            candidates = scores[:, None] + self.log_transitions
+            backpointers[row] = candidates.argmax(axis=0)
+            scores = candidates.max(axis=0) + emissions[row]
+        path = [int(scores.argmax())]
+        for row in range(len(emissions) - 1, 0, -1):
+            path.append(int(backpointers[row, path[-1]]))
+        return [self.class_ids[idx] for idx in reversed(path)]
+
+    def annotate(self, text: str) -> List[Dict[str, Any]]:
+        """Annotations (class_id, text, start, end) of text, one per run of paragraphs of the same class."""
+        paragraphs = paragraph_spans(text)
+        labels = self.predict([_paragraph_features(text, start, end) for start, end in paragraphs])
+        annotations = []
+        for (start, end), class_id in zip(paragraphs, labels):
+            if annotations and annotations[-1]['class_id'] == class_id:
+                annotations[-1]['end'] = end
+            else:
+                annotations.append({'class_id': class_id, 'start': start, 'end': end})
+        return [{'class_id': annotation['class_id'], 'text': text[annotation['start']:annotation['end']],
+                 'start': annotation['start'], 'end': annotation['end']} for annotation in annotations]
+
+    def save(self, path: str = MODEL_PATH) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            np.savez(file, class_ids=np.array(self.class_ids), vocabulary=np.array(list(self.vocabulary)),
+                     word_log_probs=self.word_log_probs, cue_log_probs=self.cue_log_probs,
+                     log_start=self.log_start, log_transitions=self.log_transitions)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = MODEL_PATH) -> 'Segmenter':
+        with np.load(path) as data:
+            return cls(data['class_ids'].tolist(), data['vocabulary'].tolist(), data['word_log_probs'],
+                       data['cue_log_probs'], data['log_start'], data['log_transitions'])
+
+
+def annotated_decisions() -> List[str]:
+    """Annotated decisions whose text file exists, i.e. the ones that can be used for training."""
+    return sorted(splitext(name)[0] for name in os.listdir(ANNOTATED_FOLDER)
+                  if name.endswith('.json') and os.path.exists(join(TXT_FOLDER, f'{splitext(name)[0]}.txt')))
+
+
+def class_ids_of_mappings(mappings_path: str = MAPPINGS_PATH) -> List[str]:
+    with open(mappings_path, 'r', encoding='utf-8') as file:
+        return list(json.load(file))
+
+
+def train(model_path: str = MODEL_PATH) -> Segmenter:
+    decisions = annotated_decisions()
+    segmenter = Segmenter.train(training_data(decisions), class_ids_of_mappings())
+    segmenter.save(model_path)
+    print(f'Model trained on {len(decisions)} annotated decisions, saved to {model_path}')
+    return segmenter
+
+
+def evaluate() -> float:
+    """Share of characters classified correctly when each annotated decision is left out of training."""
+    decisions = annotated_decisions()
+    documents = training_data(decisions)
+    class_ids = class_ids_of_mappings()
+    correct = total = 0
+    for idx, decision_number in enumerate(decisions):
+        segmenter = Segmenter.train(documents[:idx] + documents[idx + 1:], class_ids)
+        with open(join(TXT_FOLDER, f'{decision_number}.txt'), 'r', encoding='utf-8') as file:
+            text = file.read()
+        sizes = [end - start for start, end in paragraph_spans(text)]
+        predicted = segmenter.predict(documents[idx][0])
+        hits = sum(size for size, guess, label in zip(sizes, predicted, documents[idx][1]) if guess == label)
+        print(f'{decision_number}: {hits / max(sum(sizes), 1):.1%} of the characters')
+        correct += hits
+        total += sum(sizes)
+    print(f'Overall: {correct / max(total, 1):.1%}')
+    return correct / max(total, 1)
+
+
+_segmenter = None
+
+
+def _load_segmenter(model_path: str) -> None:
+    global _segmenter
+    _segmenter = Segmenter.load(model_path)
+
+
+def segment_decision(decision_number: str, output_folder: str = OUTPUT_FOLDER) -> int:
+    """Write documents/auto_annotated/<decision>.json; runs in a worker process. Returns the number of annotations."""
+    with open(join(TXT_FOLDER, f'{decision_number}.txt'), 'r', encoding='utf-8') as file:
+        text = file.read()
+    annotations = _segmenter.annotate(text)
+    data = {'document_id': '...........',
+            'text_file': f'{decision_number}.txt',
+            'court': 'ΣτΕ',
+            'legal_remedy': '..........',
+            'related_department': '...........',
+            'annotations': annotations}
+    os.makedirs(output_folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=output_folder, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, join(output_folder, f'{decision_number}.json'))
+    return len(annotations)
+
+
+def segment_decisions(decisions: Sequence[str], output_folder: str = OUTPUT_FOLDER, model_path: str = MODEL_PATH,
+                      max_workers: int = None) -> Dict[str, int]:
+    """Segment decisions in parallel; every worker loads the model once."""
+    with ProcessPoolExecutor(max_workers, initializer=_load_segmenter, initargs=(model_path,)) as executor:
+        counts = executor.map(segment_decision, decisions, [output_folder] * len(decisions),
+                              chunksize=max(1, len(decisions) // (4 * (max_workers or os.cpu_count() or 1))))
+        return dict(zip(decisions, counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-annotate decisions locally with the annotation classes.')
+    parser.add_argument('decisions', nargs='*', help='decision numbers (default: every decision of documents/txt_files without output)')
+    parser.add_argument('--retrain', action='store_true', help=f'train the model again (it is trained once into {MODEL_PATH})')
+    parser.add_argument('--evaluate', action='store_true', help='report the leave-one-decision-out accuracy and exit')
+    parser.add_argument('--overwrite', action='store_true', help='segment decisions that already have output again')
+    parser.add_argument('--max-workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--output-folder', default=OUTPUT_FOLDER)
+    args = parser.parse_args()
+
+    if args.evaluate:
+        evaluate()
+        return
+    if args.retrain or not os.path.exists(MODEL_PATH):
+        train()
+
+    decisions = args.decisions or [
+        decision for decision in sorted(splitext(name)[0] for name in os.listdir(TXT_FOLDER) if name.endswith('.txt'))
+        if args.overwrite or not os.path.exists(join(args.output_folder, f'{decision}.json'))
+    ]
+    counts = segment_decisions(decisions, args.output_folder, max_workers=args.max_workers)
+    print(f'{len(counts)} decisions segmented into {sum(counts.values())} annotations, written to {args.output_folder}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""End-to-end benchmark of the summarization pipelines against the local mock server.
+
+Starts utils.mock_openai_server in-process, points the OpenAI clients at it and runs
+every pipeline mode over the decisions of the corpus. For every decision and mode it
+reports wall time, number of requests, prompt tokens sent and peak Python memory.
+Each run uses an empty response cache and writes its summaries to a temporary folder,
+so the real summaries in documents/ are never touched.
+
+    python -m utils.benchmark --latency 0.5 --tokens-per-second 200 --json benchmark.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict
+from os.path import join, splitext
+from typing import Any, Callable, Dict, List
+
+from utils import llm_cache, metrics
+from utils.mock_openai_server import MockConfig, MockOpenAIServer, start_mock_server
+
+ANNOTATED_FOLDER = join('documents', 'annotated_decisions')
+TXT_FOLDER = join('documents', 'txt_files')
+MODES = ('structured-sequential', 'structured-concurrent', 'plain-sequential', 'plain-concurrent')
+
+
+def list_decisions(folder: str, extension: str) -> List[str]:
+    if not os.path.isdir(folder):
+        return []
+    return sorted(splitext(name)[0] for name in os.listdir(folder) if name.endswith(extension))
+
+
+def mode_runner(mode: str, output_folder: str, max_workers: int) -> Callable[[str], Any]:
+    # Imported here, after the environment points the clients at the mock server
+    if mode.startswith('structured'):
+        import main
+        use_async = mode == 'structured-concurrent'
+        return lambda decision: main.summarize_decision(decision, use_async, max_workers, output_folder)
+    import plain_summary
+    workers = max_workers if mode == 'plain-concurrent' else 1
+    return lambda decision: plain_summary.summarize_large_text(
+        decision, plain_summary.INPUT_FOLDER, output_folder, plain_summary.PROMPT, max_workers=workers
+    )
+
+
+def run_one(server: MockOpenAIServer, run: Callable[[str], Any], decision: str, cache_dir: str, verbose: bool) -> Dict[str, Any]:
+    """Run one pipeline on one decision with an empty cache and measure it."""
+    llm_cache._default_cache = llm_cache.ResponseCache(cache_dir)
+    metrics._default_recorder = metrics.Recorder(join(cache_dir, 'metrics'))
+    server.stats.reset()
+    output = None if verbose else io.StringIO()
+    tracemalloc.start()
+    started = time.perf_counter()
+    error = None
+    try:
+        with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+            run(decision)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    wall_time = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    stats = server.stats.as_dict()
+    return {
+        'decision': decision,
+        'wall_time': round(wall_time, 3),
+        'requests': stats['requests'],
+        'failures': stats['failures'],
+        'prompt_tokens': stats['prompt_tokens'],
+        'completion_tokens': stats['completion_tokens'],
+        'max_in_flight': stats['max_in_flight'],
+        'cost': round(metrics.default_recorder().metrics.totals()['cost'], 6),
+        'peak_memory_mb': round(peak / (1024 * 1024), 2),
+        'error': error,
+    }
+
+
+def run_benchmark(config: MockConfig, modes=MODES, decisions: List[str] = None, max_workers: int = 8, verbose: bool = False) -> List[Dict[str, Any]]:
+    server = start_mock_server(config)
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    os.environ.setdefault('OPENAI_KEY', 'mock')
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix='benchmark-') as workdir:
+            for mode in modes:
+                folder = ANNOTATED_FOLDER if mode.startswith('structured') else TXT_FOLDER
+                extension = '.json' if mode.startswith('structured') else '.txt'
+                available = list_decisions(folder, extension)
+                run = mode_runner(mode, join(workdir, mode), max_workers)
+                for decision in decisions or available:
+                    if decision not in available:
+                        continue
+                    result = {'mode': mode, **run_one(server, run, decision, join(workdir, 'cache'), verbose)}
+                    print(format_result(result))
+                    results.append(result)
+    finally:
+        server.shutdown()
+    return results
+
+
+def format_result(result: Dict[str, Any]) -> str:
+    line = (f"{result['mode']:<22} {result['decision']:<16} {result['wall_time']:>8.2f}s "
+            f"{result['requests']:>5} req {result['prompt_tokens']:>8} tok "
+            f"{result['max_in_flight']:>3} in flight {result['peak_memory_mb']:>8.2f} MB")
+    return f"{line}  {result['error']}" if result['error'] else line
+
+
+def print_totals(results: List[Dict[str, Any]]) -> None:
+    print('\nTotals per mode:')
+    for mode in dict.fromkeys(result['mode'] for result in results):
+        rows = [result for result in results if result['mode'] == mode]
+        print(f"{mode:<22} {len(rows):>3} decisions {sum(r['wall_time'] for r in rows):>8.2f}s "
+              f"{sum(r['requests'] for r in rows):>5} req {sum(r['prompt_tokens'] for r in rows):>8} tok "
+              f"{max(r['peak_memory_mb'] for r in rows):>8.2f} MB peak")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the summarization pipelines against a local mock API.')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--decisions', nargs='+', help='Decision numbers to run (default: the whole corpus)')
+    parser.add_argument('--max-workers', type=int, default=8, help='Concurrency of the concurrent modes')
+    defaults = MockConfig()
+    for field, value in asdict(defaults).items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(value), default=value)
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the pipelines')
+    args = parser.parse_args()
+
+    config = MockConfig(**{field: getattr(args, field) for field in asdict(defaults)})
+    print(f'Mock server: {config}')
+    results = run_benchmark(config, args.modes, args.decisions, args.max_workers, args.verbose)
+    print_totals(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump({'config': asdict(config), 'results': results}, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
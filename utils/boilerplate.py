@@ -0,0 +1,205 @@
+"""Near-duplicate paragraph index for the recurring formulas of the decisions.
+
+Council of State decisions repeat long passages (court composition, admissibility
+formulas, closing text) almost word for word. Every paragraph of an indexed decision is
+stored as a MinHash signature of its word 5-gram shingles; signatures are bucketed with
+LSH (banding) so similar paragraphs of other decisions are found without comparing every
+pair. A paragraph that has near-duplicates in at least MIN_DECISIONS - 1 other decisions
+is boilerplate and is stripped before summarization.
+
+The index is one small .npz file per decision under .cache/boilerplate, so adding a
+decision never rebuilds the index. Every decision of documents/txt_files is indexed from
+its .txt file before anything is stripped, so what is stripped from a decision does not
+depend on which decisions were summarized before it. The file is indexed after the same
+layout normalization the pipelines apply before stripping (utils/normalizer.py), and a
+decision whose file changed (another SHA-256) is indexed again:
+
+    python -m utils.boilerplate
+"""
+import argparse
+import hashlib
+import os
+import re
+import tempfile
+import zlib
+from collections import defaultdict
+from os.path import join, splitext
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from utils.lexical_metrics import tokenize
+from utils.normalizer import normalize_text
+
+INDEX_DIR = join('.cache', 'boilerplate')
+TXT_FOLDER = join('documents', 'txt_files')
+SHINGLE_WORDS = 5
+NUM_PERMUTATIONS = 128
+BANDS = 16  # 16 bands of 8 rows: pairs above ~0.7 Jaccard similarity become candidates
+SIMILARITY_THRESHOLD = 0.7
+MIN_DECISIONS = 3  # A passage is boilerplate when it appears in at least this many decisions
+MIN_WORDS = 12  # Shorter paragraphs (titles, numbers) are left alone
+
+_PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n\s*')
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = np.random.RandomState(20240101)  # fixed seed: signatures must be comparable across runs
+_A = _rng.randint(1, 1 << 31, size=NUM_PERMUTATIONS).astype(np.uint64)
+_B = _rng.randint(0, 1 << 31, size=NUM_PERMUTATIONS).astype(np.uint64)
+
+
+def paragraph_spans(text: str) -> List[Tuple[int, int]]:
+    """(start, end) offsets of the blank-line separated paragraphs of text."""
+    spans, start = [], 0
+    for match in _PARAGRAPH_BREAK.finditer(text):
+        if match.start() > start:
+            spans.append((start, match.start()))
+        start = match.end()
+    if start < len(text):
+        spans.append((start, len(text)))
+    return spans
+
+
+def minhash(text: str) -> np.ndarray:
+    """MinHash signature of the word shingles of text, or None if it is too short."""
+    words = tokenize(text)
+    if len(words) < MIN_WORDS:
+        return None
+    shingles = {' '.join(words[idx:idx + SHINGLE_WORDS]) for idx in range(len(words) - SHINGLE_WORDS + 1)}
+    # crc32 instead of hash(): Python string hashes change between processes
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    permuted = (hashes[:, None] * _A + _B) % _MERSENNE_PRIME
+    return (permuted & 0xFFFFFFFF).min(axis=0).astype(np.uint32)
+
+
+def _band_keys(signature: np.ndarray) -> List[bytes]:
+    return [bytes([band]) + band_rows.tobytes() for band, band_rows in enumerate(np.split(signature, BANDS))]
+
+
+class BoilerplateIndex:
+    def __init__(self, index_dir: str = INDEX_DIR) -> None:
+        self.index_dir = index_dir
+        self.signatures: List[np.ndarray] = []
+        self.owners: List[str] = []  # decision of every indexed paragraph
+        self.buckets: Dict[bytes, List[int]] = defaultdict(list)
+        self.decisions: Dict[str, str] = {}  # decision -> SHA-256 of the text it was indexed from
+        if os.path.isdir(index_dir):
+            for name in sorted(os.listdir(index_dir)):
+                if name.endswith('.npz'):
+                    with np.load(join(index_dir, name)) as data:
+                        source = str(data['source_sha256']) if 'source_sha256' in data.files else ''
+                        self._insert(splitext(name)[0], data['signatures'], source)
+
+    def _insert(self, decision_number: str, signatures: np.ndarray, source: str) -> None:
+        self.decisions[decision_number] = source
+        for signature in signatures:
+            idx = len(self.signatures)
+            self.signatures.append(signature)
+            self.owners.append(decision_number)
+            for key in _band_keys(signature):
+                self.buckets[key].append(idx)
+
+    def _remove(self, decision_number: str) -> None:
+        kept = [idx for idx, owner in enumerate(self.owners) if owner != decision_number]
+        signatures = [self.signatures[idx] for idx in kept]
+        owners = [self.owners[idx] for idx in kept]
+        self.signatures, self.owners, self.buckets = [], [], defaultdict(list)
+        del self.decisions[decision_number]
+        for signature, owner in zip(signatures, owners):
+            self._insert(owner, signature[None], self.decisions.get(owner, ''))
+
+    def add_decision(self, decision_number: str, text: str) -> None:
+        """Index the paragraphs of a decision once per version of its text; the file is written atomically."""
+        source = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if self.decisions.get(decision_number) == source:
+            return
+        if decision_number in self.decisions:
+            self._remove(decision_number)  # the text changed since it was indexed
+        text = normalize_text(text).text
+        signatures = [signature for signature in map(minhash, (text[start:end] for start, end in paragraph_spans(text)))
+                      if signature is not None]
+        signatures = np.array(signatures, dtype=np.uint32).reshape(-1, NUM_PERMUTATIONS)
+        os.makedirs(self.index_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            np.savez(file, signatures=signatures, source_sha256=np.array(source))
+        os.replace(tmp_path, join(self.index_dir, f'{decision_number}.npz'))
+        self._insert(decision_number, signatures, source)
+
+    def add_corpus(self, txt_folder: str = TXT_FOLDER) -> None:
+        """Index every decision of the corpus that is not indexed yet, each from its .txt file."""
+        if not os.path.isdir(txt_folder):
+            return
+        for name in sorted(os.listdir(txt_folder)):
+            decision_number, extension = splitext(name)
+            if extension == '.txt':
+                with open(join(txt_folder, name), 'r', encoding='utf-8') as file:
+                    self.add_decision(decision_number, file.read())
+
+    def duplicate_decisions(self, signature: np.ndarray, decision_number: str) -> set:
+        """Other decisions that contain a paragraph similar to the one with this signature."""
+        candidates = {idx for key in _band_keys(signature) for idx in self.buckets.get(key, ())}
+        return {
+            self.owners[idx] for idx in candidates
+            if self.owners[idx] != decision_number
+            and np.mean(self.signatures[idx] == signature) >= SIMILARITY_THRESHOLD
+        }
+
+    def boilerplate_spans(self, decision_number: str, text: str) -> List[Tuple[int, int]]:
+        spans = []
+        for start, end in paragraph_spans(text):
+            signature = minhash(text[start:end])
+            if signature is not None and len(self.duplicate_decisions(signature, decision_number)) >= MIN_DECISIONS - 1:
+                spans.append((start, end))
+        return spans
+
+    def strip(self, decision_number: str, text: str) -> str:
+        """text without its boilerplate paragraphs."""
+        removed = set(self.boilerplate_spans(decision_number, text))
+        if not removed:
+            return text
+        kept = [text[start:end] for start, end in paragraph_spans(text) if (start, end) not in removed]
+        return '\n\n'.join(kept)
+
+
+_default_index = None
+
+
+def default_index() -> BoilerplateIndex:
+    global _default_index
+    if _default_index is None:
+        _default_index = BoilerplateIndex()
+        _default_index.add_corpus()
+    return _default_index
+
+
+def strip_boilerplate(decision_number: str, text: str) -> str:
+    """Strip the boilerplate paragraphs of a decision, against the index of the whole corpus."""
+    return default_index().strip(decision_number, text)
+
+
+def strip_sections(decision_number: str, sections) -> List[Dict]:
+    """Strip the boilerplate paragraphs of every annotated section; sections left empty are dropped."""
+    sections = list(sections)
+    index = default_index()
+    stripped = [{**section, 'text': index.strip(decision_number, section['text'])} for section in sections]
+    return [section for section in stripped if section['text'].strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index the decisions and report their boilerplate paragraphs.')
+    parser.add_argument('decisions', nargs='*', help='decision numbers (default: every decision of documents/txt_files)')
+    args = parser.parse_args()
+
+    decisions = args.decisions or sorted(splitext(name)[0] for name in os.listdir(TXT_FOLDER) if name.endswith('.txt'))
+    index = default_index()
+    texts = {}
+    for decision_number in decisions:
+        with open(join(TXT_FOLDER, f'{decision_number}.txt'), 'r', encoding='utf-8') as file:
+            texts[decision_number] = normalize_text(file.read()).text
+    for decision_number, text in texts.items():
+        removed = sum(end - start for start, end in index.boilerplate_spans(decision_number, text))
+        print(f'{decision_number}: {removed} of {len(text)} characters are boilerplate ({removed / max(len(text), 1):.1%})')
+
+
+if __name__ == '__main__':
+    main()
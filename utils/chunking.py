@@ -0,0 +1,142 @@
+import re
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, NamedTuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import tiktoken
+
+# Sentence ending punctuation. In Greek ';' is the question mark and '·' the upper stop.
+_BOUNDARY = re.compile(
+    r'(?P<sentence>(?<=[.!;;·])[»"\')]*\s+(?=[«"\'(\[]?[0-9A-ZΑ-ΩΆΈΉΊΌΎΏΪΫ]))|(?P<paragraph>\n[ \t]*\n\s*)'
+)
+_PREVIOUS_WORD = re.compile(r'(\S+)\s*$')
+
+# Abbreviations that end with a period but do not end a sentence.
+ABBREVIATIONS = {
+    'αρ', 'αριθ', 'άρθ', 'αρθ', 'παρ', 'περ', 'εδ', 'υποπερ', 'στοιχ', 'κεφ', 'σελ', 'βλ', 'πρβλ', 'ν', 'νδ', 'πδ',
+    'κ', 'κλπ', 'λπ', 'πχ', 'δηλ', 'σημ', 'τηλ', 'υπ', 'φεκ', 'ολ', 'στε', 'αεδ', 'ελσυν', 'no', 'nr', 'cf', 'eg',
+}
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> 'tiktoken.Encoding':
+    """tiktoken encodings are expensive to build, so every model is loaded once per process."""
+    import tiktoken  # imported on first use, so importing this module stays cheap
+    return tiktoken.encoding_for_model(model)
+
+
+class TokenEstimator:
+    def __init__(self, model: str = 'gpt-4') -> None:
+        self.model = model
+        self.encoding = get_encoding(model)
+
+    def estimate(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+
+class Chunk(NamedTuple):
+    start: int
+    end: int
+    tokens: int
+
+
+def _is_abbreviation(text: str, boundary: int) -> bool:
+    match = _PREVIOUS_WORD.search(text, max(0, boundary - 40), boundary)
+    if not match:
+        return False
+    word = match.group(1).rstrip('»"\')').rstrip('.')
+    if '.' in word:  # Α.Ε., π.δ., κ.λπ.
+        return True
+    if word.isdigit():
+        return _is_numbering(text, match.start(1), boundary)
+    word = word.lower()
+    return len(word) == 1 or word in ABBREVIATIONS
+
+
+def _is_numbering(text: str, number_start: int, boundary: int) -> bool:
+    """A number before a period is numbering ('1. Επειδή', 'παρ. 2. 3') unless a sentence ends with it ('άρθρου 5. Η')."""
+    line_start = text.rfind('\n', 0, number_start) + 1
+    if not text[line_start:number_start].strip():
+        return True  # paragraph number at the start of a line
+    following = text[boundary:boundary + 40].lstrip('»"\') \t\n')[:1]
+    return following.isdigit() or following.islower()
+
+
+def sentence_boundaries(text: str) -> List[int]:
+    """Character offsets where a new sentence starts, always including 0 and len(text)."""
+    boundaries = [0]
+    for match in _BOUNDARY.finditer(text):
+        if match.group('sentence') and text[match.start() - 1] == '.' and _is_abbreviation(text, match.start()):
+            continue
+        if match.end() > boundaries[-1]:
+            boundaries.append(match.end())
+    if boundaries[-1] != len(text):
+        boundaries.append(len(text))
+    return boundaries
+
+
+@lru_cache(maxsize=None)
+def _token_byte_lengths(model: str) -> np.ndarray:
+    """Length in bytes of every token of the vocabulary, so offsets can be computed with NumPy."""
+    encoding = get_encoding(model)
+    lengths = np.zeros(encoding.n_vocab, dtype=np.int64)
+    for token in range(encoding.n_vocab):
+        try:
+            lengths[token] = len(encoding.decode_single_token_bytes(token))
+        except KeyError:
+            pass  # unused token id
+    return lengths
+
+
+def token_offsets(text: str, token_estimator: TokenEstimator) -> np.ndarray:
+    """Encode the whole text once and return the character offset where every token starts."""
+    tokens = np.asarray(token_estimator.encoding.encode_ordinary(text), dtype=np.int64)
+    if not len(tokens):
+        return np.zeros(0, dtype=np.int64)
+    lengths = _token_byte_lengths(token_estimator.model)[tokens]
+    byte_starts = np.cumsum(lengths) - lengths
+    data = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+    # Number of UTF-8 lead bytes up to and including each byte = index of its character + 1
+    char_index = np.cumsum((data & 0xC0) != 0x80) - 1
+    return char_index[byte_starts]
+
+
+def plan_chunks(text: str, max_tokens: int, token_estimator: TokenEstimator) -> List[Chunk]:
+    """Split text into spans of at most max_tokens tokens, cutting at sentence boundaries.
+
+    The document is tokenized once; sentence sizes are read from the token offsets. A
+    sentence longer than max_tokens is cut at token boundaries.
+    """
+    offsets = token_offsets(text, token_estimator)
+    boundaries = sentence_boundaries(text)
+    boundary_tokens = np.searchsorted(offsets, boundaries).tolist()
+
+    chunks = []
+    start_char, start_token = 0, 0
+    previous_char, previous_token = 0, 0
+    for boundary, boundary_token in zip(boundaries[1:], boundary_tokens[1:]):
+        if boundary_token - start_token <= max_tokens:
+            previous_char, previous_token = boundary, boundary_token
+            continue
+        if previous_token > start_token:
+            chunks.append(Chunk(start_char, previous_char, previous_token - start_token))
+            start_char, start_token = previous_char, previous_token
+        # A single sentence over the limit: cut it at token offsets.
+        while boundary_token - start_token > max_tokens:
+            cut_token = start_token + max_tokens
+            cut_char = int(offsets[cut_token])
+            chunks.append(Chunk(start_char, cut_char, max_tokens))
+            start_char, start_token = cut_char, cut_token
+        previous_char, previous_token = boundary, boundary_token
+
+    if previous_char > start_char:
+        chunks.append(Chunk(start_char, previous_char, previous_token - start_token))
+    return chunks
+
+
+def split_text_into_chunks(text: str, max_tokens: int, token_estimator: TokenEstimator) -> List[str]:
+    """Split text into chunks of at most max_tokens tokens (see plan_chunks)."""
+    chunks = [text[chunk.start:chunk.end].strip() for chunk in plan_chunks(text, max_tokens, token_estimator)]
+    return [chunk for chunk in chunks if chunk]
@@ -0,0 +1,303 @@
+"""Similar-section and similar-decision lookup over SBERT embeddings.
+
+The index keeps the embeddings of every annotated section and every summary in one
+float32 file that is memory-mapped for queries, so opening it is instant and only the
+pages a query touches are read. The files under .cache/embedding_index are:
+
+    index.json        model name and dimension
+    vectors.f32       (rows, dim) normalized embeddings, appended as decisions arrive
+    signatures.u64    one 64-bit random-hyperplane signature per row (approximate search)
+    meta.jsonl        one line per row: id, decision, kind, class_id, source, sha1 of the text, preview
+
+meta.jsonl is written last, so a row exists only once its line is complete; bytes of
+an interrupted append are cut off by the next one. A text that changed (a regenerated
+summary) is embedded again and its new row replaces the old one, which stays in the
+files but is no longer searched until ``build --rebuild``. Exact search is one matrix-vector
+product and an argpartition. Approximate search ranks the rows by the Hamming distance
+of their signatures and scores only the best candidates exactly.
+
+    python -m utils.embedding_index build
+    python -m utils.embedding_index query "αίτηση ακυρώσεως κατά της άδειας δόμησης" -k 5
+    python -m utils.embedding_index similar ste_2325-2023 --kind summary
+"""
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+from os.path import join, splitext
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from utils.sentencebertscore import DEFAULT_MODEL, SbertEvaluator
+
+INDEX_DIR = join('.cache', 'embedding_index')
+HEADER_FILE = 'index.json'
+VECTORS_FILE = 'vectors.f32'
+SIGNATURES_FILE = 'signatures.u64'
+META_FILE = 'meta.jsonl'
+SIGNATURE_BITS = 64
+MIN_CANDIDATES = 512  # rows scored exactly by an approximate search, at least
+CANDIDATES_PER_RESULT = 32
+PREVIEW_LENGTH = 120
+
+ANNOTATED_FOLDERS = (join('documents', 'annotated_decisions'), join('documents', 'auto_annotated'))
+SUMMARY_FOLDERS = (join('documents', 'ste_summaries'), join('documents', 'my_summaries'), join('documents', 'plain_summaries'))
+
+Result = Tuple[float, Dict[str, Any]]
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _hyperplanes(dim: int) -> np.ndarray:
+    # Fixed seed: the signatures of every append must use the same hyperplanes
+    return np.random.RandomState(20240601).standard_normal((SIGNATURE_BITS, dim)).astype(np.float32)
+
+
+class EmbeddingIndex:
+    def __init__(self, index_dir: str = INDEX_DIR, model_name: str = DEFAULT_MODEL) -> None:
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self.dim = None
+        self.meta: List[Dict[str, Any]] = []
+        self.hashes: Dict[str, str] = {}  # id -> sha1 of the text of its latest row
+        self._meta_bytes = 0
+        self._evaluator = None
+        self._vectors = self._signatures = None
+        self._update_filters()
+        header_path = join(index_dir, HEADER_FILE)
+        if os.path.exists(header_path):
+            with open(header_path, 'r', encoding='utf-8') as file:
+                header = json.load(file)
+            if header['model'] != model_name:
+                raise ValueError(f"{index_dir} holds embeddings of {header['model']}, not {model_name}")
+            self.dim = header['dim']
+            self._load_meta()
+
+    def _load_meta(self) -> None:
+        meta_path = join(self.index_dir, META_FILE)
+        content = b''
+        if os.path.exists(meta_path):  # otherwise no row was completed: the index is empty
+            with open(meta_path, 'rb') as file:
+                content = file.read()
+        # A line without its newline is an append that did not finish
+        self._meta_bytes = content.rfind(b'\n') + 1
+        for line in content[:self._meta_bytes].decode('utf-8').splitlines():
+            self.meta.append(json.loads(line))
+        self.hashes = {entry['id']: entry.get('sha1') for entry in self.meta}
+        self._update_filters()
+
+    def _update_filters(self) -> None:
+        self.kinds = np.array([entry['kind'] for entry in self.meta])
+        self.decisions = np.array([entry['decision'] for entry in self.meta])
+        # Only the latest row of an id is searched
+        latest = {entry['id']: row for row, entry in enumerate(self.meta)}
+        self.live = np.zeros(len(self.meta), dtype=bool)
+        self.live[np.fromiter(latest.values(), dtype=np.int64, count=len(latest))] = True
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    @property
+    def evaluator(self) -> SbertEvaluator:
+        # Same model and embedding cache as utils/sentencebertscore.py
+        if self._evaluator is None:
+            self._evaluator = SbertEvaluator(self.model_name)
+        return self._evaluator
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None or len(self._vectors) != len(self):
+            self._vectors = self._map(VECTORS_FILE, np.float32, self.dim)
+        return self._vectors
+
+    @property
+    def signatures(self) -> np.ndarray:
+        if self._signatures is None or len(self._signatures) != len(self):
+            self._signatures = self._map(SIGNATURES_FILE, np.uint64, 1)[:, 0]
+        return self._signatures
+
+    def _map(self, name: str, dtype, width: int) -> np.ndarray:
+        if not len(self):
+            return np.zeros((0, width), dtype=dtype)
+        return np.memmap(join(self.index_dir, name), dtype=dtype, mode='r', shape=(len(self), width))
+
+    def _signature_of(self, vectors: np.ndarray) -> np.ndarray:
+        bits = (vectors @ _hyperplanes(self.dim).T) > 0
+        return np.packbits(bits, axis=-1, bitorder='little').view(np.uint64)
+
+    # Appends
+
+    def add(self, entries: Sequence[Dict[str, Any]], texts: Sequence[str]) -> int:
+        """Embed and append the texts that are not indexed yet or changed. Returns the number added.
+
+        Every entry needs an id, a decision and a kind ('section' or 'summary').
+        """
+        new = {}
+        for entry, text in zip(entries, texts):
+            digest = _digest(text)
+            if text.strip() and self.hashes.get(entry['id']) != digest:
+                new[entry['id']] = ({**entry, 'sha1': digest}, text)
+        new = list(new.values())
+        if not new:
+            return 0
+        vectors = self.evaluator.embed_texts([text for _, text in new]).astype(np.float32)
+        os.makedirs(self.index_dir, exist_ok=True)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump({'model': self.model_name, 'dim': self.dim}, file)
+            os.replace(tmp_path, join(self.index_dir, HEADER_FILE))
+
+        self._vectors = self._signatures = None  # the maps are reopened with the new row count
+        for name, rows, row_bytes in ((VECTORS_FILE, vectors, 4 * self.dim),
+                                      (SIGNATURES_FILE, self._signature_of(vectors), 8)):
+            path = join(self.index_dir, name)
+            with open(path, 'ab') as file:
+                file.truncate(len(self) * row_bytes)  # drop the rows of an interrupted append
+                file.write(np.ascontiguousarray(rows).tobytes())
+        lines = []
+        for entry, text in new:
+            entry = {**entry, 'chars': len(text), 'preview': ' '.join(text.split())[:PREVIEW_LENGTH]}
+            lines.append(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.meta.append(entry)
+            self.hashes[entry['id']] = entry['sha1']
+        content = ''.join(lines).encode('utf-8')
+        with open(join(self.index_dir, META_FILE), 'ab') as file:
+            file.truncate(self._meta_bytes)
+            file.write(content)
+        self._meta_bytes += len(content)
+        self._update_filters()
+        return len(new)
+
+    # Queries
+
+    def embed(self, text: str) -> np.ndarray:
+        return self.evaluator.embed_texts([text])[0]
+
+    def decision_vector(self, decision_number: str, kind: str = None) -> np.ndarray:
+        """Normalized mean of the embeddings of a decision (its sections, its summaries or both)."""
+        rows = np.flatnonzero(self.live & (self.decisions == decision_number) & ((self.kinds == kind) if kind else True))
+        if not len(rows):
+            raise KeyError(f'{decision_number} is not in the index')
+        vector = self.vectors[rows].mean(axis=0)
+        return vector / (np.linalg.norm(vector) or 1)
+
+    def search(self, query: np.ndarray, k: int = 10, kind: str = None, exclude_decision: str = None,
+               approximate: bool = False) -> List[Result]:
+        """The k rows most similar to a normalized query vector, as (cosine similarity, meta entry), best first."""
+        if not len(self):
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        mask = self.live.copy()
+        if kind:
+            mask &= self.kinds == kind
+        if exclude_decision:
+            mask &= self.decisions != exclude_decision
+        candidates = max(MIN_CANDIDATES, CANDIDATES_PER_RESULT * k)
+        if approximate and len(self) > candidates:
+            distances = np.bitwise_count(self.signatures ^ self._signature_of(query[None])[0, 0]).astype(np.int16)
+            distances[~mask] = SIGNATURE_BITS + 1
+            rows = np.sort(np.argpartition(distances, candidates - 1)[:candidates])
+            rows = rows[mask[rows]]
+            scores = self.vectors[rows] @ query
+        else:
+            # One pass over the whole map is faster than gathering the filtered rows
+            rows = np.flatnonzero(mask)
+            scores = (self.vectors @ query)[rows]
+        k = min(k, len(rows))
+        if not k:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(float(scores[idx]), self.meta[rows[idx]]) for idx in top]
+
+    def query(self, text: str, k: int = 10, **filters) -> List[Result]:
+        return self.search(self.embed(text), k, **filters)
+
+    def similar_decisions(self, decision_number: str, k: int = 10, kind: str = 'summary',
+                          approximate: bool = False) -> List[Result]:
+        """Rows of other decisions closest to the mean embedding of a decision."""
+        return self.search(self.decision_vector(decision_number, kind), k, kind, decision_number, approximate)
+
+
+def _list_decisions(folder: str, extension: str) -> List[str]:
+    if not os.path.isdir(folder):
+        return []
+    return sorted(splitext(name)[0] for name in os.listdir(folder) if name.endswith(extension))
+
+
+def corpus_entries() -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Sections of the annotated (or else auto-annotated) decisions and every summary."""
+    entries, texts, seen = [], [], set()
+    for folder in ANNOTATED_FOLDERS:
+        for decision_number in _list_decisions(folder, '.json'):
+            if decision_number in seen:
+                continue
+            seen.add(decision_number)
+            with open(join(folder, f'{decision_number}.json'), 'r', encoding='utf-8') as file:
+                annotations = json.load(file)['annotations']
+            for idx, annotation in enumerate(annotations):
+                entries.append({'id': f'{decision_number}:section:{idx}', 'decision': decision_number, 'kind': 'section',
+                                'class_id': annotation['class_id'], 'source': os.path.basename(folder)})
+                texts.append(annotation['text'])
+    for folder in SUMMARY_FOLDERS:
+        for decision_number in _list_decisions(folder, '.txt'):
+            with open(join(folder, f'{decision_number}.txt'), 'r', encoding='utf-8') as file:
+                texts.append(file.read())
+            entries.append({'id': f'{decision_number}:summary:{os.path.basename(folder)}', 'decision': decision_number,
+                            'kind': 'summary', 'source': os.path.basename(folder)})
+    return entries, texts
+
+
+def build(index: EmbeddingIndex) -> int:
+    """Append every section and summary of the corpus that is not indexed yet or changed."""
+    entries, texts = corpus_entries()
+    return index.add(entries, texts)
+
+
+def print_results(results: List[Result], elapsed: float) -> None:
+    for score, entry in results:
+        label = entry.get('class_id') or entry['source']
+        print(f"{score:.4f}  {entry['id']:<36} {label:<16} {entry['preview']}")
+    print(f'{len(results)} results in {elapsed * 1000:.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and query the embedding index of sections and summaries.')
+    parser.add_argument('--index-dir', default=INDEX_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='append the sections and summaries that are new or changed')
+    build_parser.add_argument('--rebuild', action='store_true', help='delete the index first')
+    for name, help_text in (('query', 'rows most similar to a text'), ('similar', 'rows of other decisions similar to a decision')):
+        query_parser = subparsers.add_parser(name, help=help_text)
+        query_parser.add_argument('text' if name == 'query' else 'decision')
+        query_parser.add_argument('-k', type=int, default=10)
+        query_parser.add_argument('--kind', choices=('section', 'summary'), default=None if name == 'query' else 'summary')
+        query_parser.add_argument('--approximate', action='store_true', help='search the hyperplane signatures first')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.rebuild:
+            for name in (HEADER_FILE, VECTORS_FILE, SIGNATURES_FILE, META_FILE):
+                if os.path.exists(join(args.index_dir, name)):
+                    os.remove(join(args.index_dir, name))
+        index = EmbeddingIndex(args.index_dir)
+        added = build(index)
+        print(f'{added} rows added, {len(index)} rows in {args.index_dir}')
+        return
+
+    index = EmbeddingIndex(args.index_dir)
+    query = index.embed(args.text) if args.command == 'query' else index.decision_vector(args.decision, args.kind)
+    started = time.perf_counter()
+    results = index.search(query, args.k, args.kind, getattr(args, 'decision', None), args.approximate)
+    print_results(results, time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    main()
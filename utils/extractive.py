@@ -0,0 +1,127 @@
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+from utils.chunking import TokenEstimator, sentence_boundaries, token_offsets
+from utils.lexical_metrics import tokenize
+from utils.request_planner import class_name_of
+
+DAMPING = 0.85
+MAX_ITERATIONS = 100
+TOLERANCE = 1e-6
+
+
+class _Sentences:
+    """Sentence spans of a section with their token counts and term ids."""
+
+    def __init__(self, text: str, token_estimator: TokenEstimator, vocabulary: Dict[str, int]) -> None:
+        self.text = text
+        boundaries = sentence_boundaries(text)
+        self.spans = [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if text[start:end].strip()]
+        offsets = token_offsets(text, token_estimator)
+        starts = np.searchsorted(offsets, [start for start, _ in self.spans])
+        ends = np.searchsorted(offsets, [end for _, end in self.spans])
+        self.tokens = ends - starts
+        self.terms = [
+            np.unique(np.array([vocabulary.setdefault(word, len(vocabulary)) for word in tokenize(text[start:end])], dtype=np.int64))
+            for start, end in self.spans
+        ]
+
+
+def textrank_scores(terms: Sequence[np.ndarray], idf: np.ndarray) -> np.ndarray:
+    """Centrality of every sentence in the graph of TF-IDF cosine similarities (TextRank)."""
+    count = len(terms)
+    if count <= 2:
+        return np.ones(count)
+    section_terms, inverse = np.unique(np.concatenate(terms), return_inverse=True)
+    matrix = np.zeros((count, len(section_terms)), dtype=np.float32)
+    rows = np.repeat(np.arange(count), [len(sentence_terms) for sentence_terms in terms])
+    matrix[rows, inverse] = idf[section_terms][inverse]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms > 0, norms, 1)
+
+    similarity = matrix @ matrix.T
+    np.fill_diagonal(similarity, 0)
+    row_sums = similarity.sum(axis=1, keepdims=True)
+    # Sentences without any similar sentence spread their score evenly
+    transition = np.where(row_sums > 0, similarity / np.where(row_sums > 0, row_sums, 1), 1 / count)
+
+    scores = np.full(count, 1 / count)
+    for _ in range(MAX_ITERATIONS):
+        updated = (1 - DAMPING) / count + DAMPING * (transition.T @ scores)
+        if np.abs(updated - scores).sum() < TOLERANCE:
+            return updated
+        scores = updated
+    return scores
+
+
+def allocate_budgets(sizes: Sequence[int], weights: Sequence[float], total_budget: int) -> List[int]:
+    """Share total_budget between sections in proportion to weight * size, never more than a section's size.
+
+    The budget a section cannot use (because it is smaller than its share) is shared
+    again between the remaining sections.
+    """
+    sizes = np.asarray(sizes, dtype=np.float64)
+    demand = np.asarray(weights, dtype=np.float64) * sizes
+    budgets = np.zeros(len(sizes))
+    active = demand > 0
+    remaining = float(total_budget)
+    while active.any() and remaining > 0:
+        share = remaining * demand / demand[active].sum()
+        capped = active & (share >= sizes)
+        if not capped.any():
+            budgets[active] = share[active]
+            break
+        budgets[capped] = sizes[capped]
+        remaining -= sizes[capped].sum()
+        active &= ~capped
+    return budgets.astype(int).tolist()
+
+
+def extract(sentences: _Sentences, budget: int, idf: np.ndarray) -> str:
+    """The highest ranked sentences that fit in budget tokens, in document order."""
+    if budget <= 0:
+        return ''
+    if sentences.tokens.sum() <= budget:
+        return sentences.text
+    scores = textrank_scores(sentences.terms, idf)
+    selected, used = [], 0
+    for idx in np.argsort(-scores, kind='stable'):
+        if used + sentences.tokens[idx] <= budget:
+            selected.append(idx)
+            used += sentences.tokens[idx]
+    return ' '.join(sentences.text[slice(*sentences.spans[idx])].strip() for idx in sorted(selected))
+
+
+def compress_sections(
+        sections: Sequence[Dict[str, Any]],
+        annotation_mappings: Dict[str, Any],
+        token_estimator: TokenEstimator,
+        total_budget: int) -> List[Dict[str, Any]]:
+    """Shrink the sections of a decision to about total_budget tokens by keeping their most central sentences.
+
+    Every section gets a share of the budget proportional to the importance of its class
+    (annotation_mappings) and to its size. Sections of zero importance are dropped and
+    sections smaller than their share are kept whole. Sentences are ranked with TextRank
+    over TF-IDF vectors; the IDF is computed over the sentences of the whole decision.
+    """
+    importance = {info['name']: info.get('importance', 0) for info in annotation_mappings.values()}
+    vocabulary: Dict[str, int] = {}
+    parsed = [_Sentences(section['text'], token_estimator, vocabulary) for section in sections]
+
+    document_frequency = np.zeros(len(vocabulary))
+    for sentences in parsed:
+        for terms in sentences.terms:
+            document_frequency[terms] += 1
+    sentence_count = sum(len(sentences.terms) for sentences in parsed)
+    idf = np.log((1 + sentence_count) / (1 + document_frequency)) + 1
+
+    weights = [importance.get(class_name_of(section, annotation_mappings), 0) for section in sections]
+    budgets = allocate_budgets([int(sentences.tokens.sum()) for sentences in parsed], weights, total_budget)
+
+    compressed = []
+    for section, sentences, budget in zip(sections, parsed, budgets):
+        text = extract(sentences, budget, idf)
+        if text:
+            compressed.append({**section, 'text': text})
+    return compressed
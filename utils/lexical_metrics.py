@@ -0,0 +1,110 @@
+import re
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+_WORD = re.compile(r'\w+')
+
+METRICS = ('rouge1', 'rouge2', 'rougeL', 'token_f1')
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens with Greek accents and diaeresis removed (ά -> α, ς -> σ).
+
+    rouge_score's default tokenizer drops every non-ASCII character, which leaves
+    nothing of a Greek summary, so the metrics below tokenize on their own.
+    """
+    decomposed = unicodedata.normalize('NFD', text.casefold())
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return _WORD.findall(stripped)
+
+
+class NgramCounts:
+    """Sorted unique n-gram keys with their counts, for n = 1 and 2."""
+
+    def __init__(self, ids: np.ndarray, vocab_size: int) -> None:
+        self.length = len(ids)
+        self.unigrams = np.unique(ids, return_counts=True)
+        # A bigram (a, b) is encoded as a * vocab_size + b, which is unique per pair
+        self.bigrams = np.unique(ids[:-1] * vocab_size + ids[1:], return_counts=True)
+
+
+def _overlap(reference: Tuple[np.ndarray, np.ndarray], candidate: Tuple[np.ndarray, np.ndarray]) -> int:
+    _, reference_idx, candidate_idx = np.intersect1d(
+        reference[0], candidate[0], assume_unique=True, return_indices=True
+    )
+    return int(np.minimum(reference[1][reference_idx], candidate[1][candidate_idx]).sum())
+
+
+def _f1(overlap: int, reference_total: int, candidate_total: int) -> float:
+    if not overlap:
+        return 0.0
+    precision, recall = overlap / candidate_total, overlap / reference_total
+    return 2 * precision * recall / (precision + recall)
+
+
+def lcs_length(reference: np.ndarray, candidate: np.ndarray) -> int:
+    """Length of the longest common subsequence with the bit-parallel algorithm (Hyyrö, 2004).
+
+    Each reference position is one bit of a Python integer, so every candidate
+    token costs a handful of big-integer operations instead of a DP row.
+    """
+    if not len(reference) or not len(candidate):
+        return 0
+    match_masks = {}
+    for position, token in enumerate(reference.tolist()):
+        match_masks[token] = match_masks.get(token, 0) | (1 << position)
+
+    full = (1 << len(reference)) - 1
+    v = full
+    for token in candidate.tolist():
+        u = v & match_masks.get(token, 0)
+        v = ((v + u) | (v - u)) & full
+    return len(reference) - bin(v).count('1')
+
+
+def score_against_reference(reference: str, candidates: Dict[str, str]) -> Dict[str, Dict[str, float]]:
+    """ROUGE-1/2/L and token-overlap F1 of every candidate against one reference.
+
+    The reference is tokenized and counted once and reused for every candidate.
+    token_f1 is the F1 of the sets of distinct tokens, while ROUGE-1 counts repetitions.
+    """
+    vocabulary = {}
+    to_ids = lambda tokens: np.array([vocabulary.setdefault(token, len(vocabulary)) for token in tokens], dtype=np.int64)
+    reference_ids = to_ids(tokenize(reference))
+    candidate_ids = {system: to_ids(tokenize(text)) for system, text in candidates.items()}
+
+    vocab_size = max(len(vocabulary), 1)
+    reference_counts = NgramCounts(reference_ids, vocab_size)
+    scores = {}
+    for system, ids in candidate_ids.items():
+        counts = NgramCounts(ids, vocab_size)
+        reference_types, candidate_types = len(reference_counts.unigrams[0]), len(counts.unigrams[0])
+        scores[system] = {
+            'rouge1': _f1(_overlap(reference_counts.unigrams, counts.unigrams), reference_counts.length, counts.length),
+            'rouge2': _f1(
+                _overlap(reference_counts.bigrams, counts.bigrams),
+                max(reference_counts.length - 1, 0), max(counts.length - 1, 0)
+            ),
+            'rougeL': _f1(lcs_length(reference_ids, ids), reference_counts.length, counts.length),
+            'token_f1': _f1(
+                len(np.intersect1d(reference_counts.unigrams[0], counts.unigrams[0], assume_unique=True)),
+                reference_types, candidate_types
+            ),
+        }
+    return scores
+
+
+def _score_job(job):
+    decision_number, reference, candidates = job
+    return decision_number, score_against_reference(reference, candidates)
+
+
+def score_corpus(jobs: List[Tuple[str, str, Dict[str, str]]], workers: int = None) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Score (decision_number, reference, {system: candidate}) jobs across worker processes."""
+    if len(jobs) <= 1 or workers == 1:
+        return dict(map(_score_job, jobs))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(executor.map(_score_job, jobs, chunksize=max(1, len(jobs) // 64)))
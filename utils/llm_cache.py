@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Dict, Optional
+
+DEFAULT_CACHE_DIR = os.getenv('LLM_CACHE_DIR', os.path.join('.cache', 'llm'))
+DEFAULT_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_MB', '512')) * 1024 * 1024
+
+
+class ResponseCache:
+    """On-disk cache of chat completion responses, keyed by a hash of the full request.
+
+    Every entry is a small JSON file under ``cache_dir``. Entries are written atomically
+    (temporary file + ``os.replace``) so several runs can share the same directory.
+    The modification time of an entry is refreshed on every hit and the least
+    recently used entries are evicted once the cache grows beyond ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+
+    @staticmethod
+    def make_key(request: Dict[str, Any]) -> str:
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def get(self, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        path = self._path(self.make_key(request))
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+            os.utime(path)  # LRU: mark as recently used
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['response']
+
+    def put(self, request: Dict[str, Any], response: Dict[str, Any]) -> None:
+        path = self._path(self.make_key(request))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({'request': request, 'response': response}, ensure_ascii=False).encode('utf-8')
+        try:
+            replaced = os.path.getsize(path)  # an entry that is overwritten no longer counts
+        except FileNotFoundError:
+            replaced = 0
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if self._size is None:
+            self._size = self._disk_usage()
+        else:
+            self._size += len(data) - replaced
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # removed by a concurrent run
+                yield path, stat.st_mtime, stat.st_size
+
+    def _disk_usage(self) -> int:
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache is below 90% of max_bytes."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        target = int(self.max_bytes * 0.9)
+        for path, _, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+_default_cache = None
+
+
+def default_cache() -> ResponseCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResponseCache()
+    return _default_cache
@@ -0,0 +1,149 @@
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Tuple
+
+from utils.llm_cache import ResponseCache, default_cache
+from utils.metrics import default_recorder
+from utils.rate_governor import RateGovernor, default_governor
+
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletion
+
+
+class StreamStats(NamedTuple):
+    time_to_first_token: float
+    duration: float
+    completion_tokens: int
+
+    @property
+    def tokens_per_second(self) -> float:
+        generation_time = self.duration - self.time_to_first_token
+        return self.completion_tokens / generation_time if generation_time > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f'TTFT {self.time_to_first_token:.2f}s, {self.completion_tokens} tokens, '
+                f'{self.tokens_per_second:.1f} tokens/s')
+
+
+class _StreamAccumulator:
+    """Collects the chunks of a streamed completion into a regular ChatCompletion."""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self.parts: List[str] = []
+        self.deltas = 0
+        self.meta: Dict[str, Any] = {}
+        self.finish_reason = None
+        self.usage = None
+
+    def add(self, chunk) -> None:
+        self.meta = {'id': chunk.id, 'created': chunk.created, 'model': chunk.model}
+        usage = getattr(chunk, 'usage', None)  # only sent with stream_options (openai>=1.26)
+        if usage is not None:
+            self.usage = usage.model_dump(mode='json')
+        for choice in chunk.choices:
+            if choice.delta.content:
+                if self.first_token_at is None:
+                    self.first_token_at = time.perf_counter()
+                self.parts.append(choice.delta.content)
+                self.deltas += 1
+            if choice.finish_reason:
+                self.finish_reason = choice.finish_reason
+
+    def result(self) -> Tuple['ChatCompletion', StreamStats]:
+        finished = time.perf_counter()
+        response = _chat_completion({
+            **self.meta,
+            'object': 'chat.completion',
+            'choices': [{
+                'index': 0,
+                'finish_reason': self.finish_reason or 'stop',
+                'message': {'role': 'assistant', 'content': ''.join(self.parts)},
+            }],
+            'usage': self.usage,
+        })
+        completion_tokens = self.usage['completion_tokens'] if self.usage else self.deltas
+        stats = StreamStats(
+            (self.first_token_at or finished) - self.started, finished - self.started, completion_tokens
+        )
+        return response, stats
+
+
+def _chat_completion(data: Dict[str, Any]) -> 'ChatCompletion':
+    # Deferred import: loading openai takes most of a second
+    from openai.types.chat import ChatCompletion
+    return ChatCompletion.model_validate(data)
+
+
+def _stream_request(request: Dict[str, Any]) -> Dict[str, Any]:
+    return {**request, 'stream': True, 'stream_options': {'include_usage': True}}
+
+
+def _record(request: Dict[str, Any], started: float, response: Dict[str, Any], cached: bool = False, stats: StreamStats = None) -> None:
+    default_recorder().record_call(
+        request.get('model', ''), time.perf_counter() - started, response.get('usage'), cached,
+        stats.time_to_first_token if stats else None,
+    )
+
+
+def chat_completion(client, request: Dict[str, Any], cache: Optional[ResponseCache] = None, stream: bool = False,
+                    governor: Optional[RateGovernor] = None) -> 'ChatCompletion':
+    """Run ``client.chat.completions.create(**request)`` unless an identical request is cached.
+
+    With stream=True the completion is consumed as token deltas and its time to first
+    token and tokens/second are printed. The result is the same ChatCompletion either way.
+    Requests go through the rate governor, which throttles them and retries failures.
+    """
+    cache = cache or default_cache()
+    started = time.perf_counter()
+    cached = cache.get(request)
+    if cached is not None:
+        _record(request, started, cached, cached=True)
+        return _chat_completion(cached)
+
+    governor = governor or default_governor()
+    stats = None
+    if stream:
+        def consume(chunks) -> Tuple['ChatCompletion', StreamStats]:
+            accumulator = _StreamAccumulator()
+            for chunk in chunks:
+                accumulator.add(chunk)
+            return accumulator.result()
+
+        response, stats = governor.create(client, _stream_request(request), consume)
+        print(f'Stream: {stats}')
+    else:
+        response = governor.create(client, request)
+    dumped = response.model_dump(mode='json')
+    _record(request, started, dumped, stats=stats)
+    cache.put(request, dumped)
+    return response
+
+
+async def chat_completion_async(client, request: Dict[str, Any], cache: Optional[ResponseCache] = None, stream: bool = False,
+                                governor: Optional[RateGovernor] = None) -> 'ChatCompletion':
+    """Async counterpart of chat_completion for AsyncOpenAI clients."""
+    cache = cache or default_cache()
+    started = time.perf_counter()
+    cached = cache.get(request)
+    if cached is not None:
+        _record(request, started, cached, cached=True)
+        return _chat_completion(cached)
+
+    governor = governor or default_governor()
+    stats = None
+    if stream:
+        async def consume(chunks) -> Tuple['ChatCompletion', StreamStats]:
+            accumulator = _StreamAccumulator()
+            async for chunk in chunks:
+                accumulator.add(chunk)
+            return accumulator.result()
+
+        response, stats = await governor.create_async(client, _stream_request(request), consume)
+        print(f'Stream: {stats}')
+    else:
+        response = await governor.create_async(client, request)
+    dumped = response.model_dump(mode='json')
+    _record(request, started, dumped, stats=stats)
+    cache.put(request, dumped)
+    return response
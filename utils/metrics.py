@@ -0,0 +1,210 @@
+"""Latency, token and cost accounting for LLM calls and pipeline stages.
+
+Every LLM call and every timed stage becomes one JSON line in the trace file
+(METRICS_DIR/traces.jsonl) and is added to in-memory totals, which can be written as
+a Prometheus text snapshot (METRICS_DIR/metrics.prom). The snapshot of a whole batch
+run can be rebuilt from the traces with ``python -m utils.metrics``.
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+METRICS_DIR = os.getenv('METRICS_DIR', 'metrics')
+TRACE_FILE = 'traces.jsonl'
+SNAPSHOT_FILE = 'metrics.prom'
+
+# USD per million (prompt, completion) tokens
+PRICES = {
+    'gpt-3.5-turbo': (0.50, 1.50),
+    'gpt-4': (30.00, 60.00),
+    'gpt-4-turbo': (10.00, 30.00),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+}
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Cost in USD; dated model snapshots (gpt-4-0613) use the price of their base model."""
+    name = max((name for name in PRICES if model == name or model.startswith(f'{name}-')), key=len, default=None)
+    if name is None:
+        return 0.0
+    prompt_price, completion_price = PRICES[name]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+class Metrics:
+    """Thread-safe totals per model and per stage, fed by trace events."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls = defaultdict(lambda: defaultdict(float))  # model -> counter -> value
+        self.stages = defaultdict(lambda: defaultdict(float))  # stage -> counter -> value
+        self.normalization = defaultdict(float)  # counter -> value
+
+    def add(self, event: Dict[str, Any]) -> None:
+        with self.lock:
+            if event['type'] == 'llm_call':
+                counters = self.calls[event['model']]
+                counters['requests'] += 1
+                if event.get('cached'):
+                    counters['cache_hits'] += 1
+                    return
+                counters['seconds'] += event['duration']
+                counters['prompt_tokens'] += event['prompt_tokens']
+                counters['completion_tokens'] += event['completion_tokens']
+                counters['cost'] += event['cost']
+            elif event['type'] == 'stage':
+                counters = self.stages[event['stage']]
+                counters['count'] += 1
+                counters['seconds'] += event['duration']
+            elif event['type'] == 'normalize':
+                self.normalization['tokens'] += event['tokens']
+                self.normalization['tokens_saved'] += event['tokens'] - event['normalized_tokens']
+
+    def totals(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                key: sum(counters[key] for counters in self.calls.values())
+                for key in ('requests', 'cache_hits', 'prompt_tokens', 'completion_tokens', 'cost')
+            }
+
+    def prometheus(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples) -> None:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{value_}"' for key, value_ in labels.items())
+                lines.append(f'{name}{{{label_text}}} {value:g}')
+
+        with self.lock:
+            calls = sorted(self.calls.items())
+            stages = sorted(self.stages.items())
+            tokens_saved = self.normalization['tokens_saved']
+        for counter, name, help_text in (
+                ('requests', 'llm_requests_total', 'LLM calls, including cache hits.'),
+                ('cache_hits', 'llm_cache_hits_total', 'LLM calls answered by the response cache.'),
+                ('prompt_tokens', 'llm_prompt_tokens_total', 'Prompt tokens reported by the API.'),
+                ('completion_tokens', 'llm_completion_tokens_total', 'Completion tokens reported by the API.'),
+                ('cost', 'llm_cost_usd_total', 'Estimated cost in USD.'),
+                ('seconds', 'llm_request_seconds_total', 'Time spent waiting for the API.')):
+            metric(name, 'counter', help_text, [({'model': model}, counters[counter]) for model, counters in calls])
+        metric('stage_runs_total', 'counter', 'Completed runs of a pipeline stage.',
+               [({'stage': stage}, counters['count']) for stage, counters in stages])
+        metric('stage_seconds_total', 'counter', 'Wall time spent in a pipeline stage.',
+               [({'stage': stage}, counters['seconds']) for stage, counters in stages])
+        metric('normalization_tokens_saved_total', 'counter', 'Input tokens removed by layout normalization.',
+               [({}, tokens_saved)])
+        return '\n'.join(lines) + '\n'
+
+
+class Recorder:
+    """Appends trace events to a JSONL file and keeps their totals in memory."""
+
+    def __init__(self, metrics_dir: str = METRICS_DIR) -> None:
+        self.metrics_dir = metrics_dir
+        self.trace_path = os.path.join(metrics_dir, TRACE_FILE)
+        self.metrics = Metrics()
+        self.labels: Dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def set_labels(self, **labels: str) -> None:
+        """Labels (decision, pipeline, ...) added to every following event."""
+        self.labels = labels
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        event = {'time': round(time.time(), 3), **self.labels, **event}
+        self.metrics.add(event)
+        line = json.dumps(event, ensure_ascii=False) + '\n'
+        with self.lock:
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            with open(self.trace_path, 'a', encoding='utf-8') as file:
+                file.write(line)
+
+    def record_call(self, model: str, duration: float, usage: Optional[Dict[str, Any]], cached: bool = False,
+                    time_to_first_token: float = None) -> None:
+        prompt_tokens = (usage or {}).get('prompt_tokens') or 0
+        completion_tokens = (usage or {}).get('completion_tokens') or 0
+        event = {
+            'type': 'llm_call',
+            'model': model,
+            'duration': round(duration, 4),
+            'cached': cached,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cost': 0.0 if cached else estimate_cost(model, prompt_tokens, completion_tokens),
+        }
+        if time_to_first_token is not None:
+            event['time_to_first_token'] = round(time_to_first_token, 4)
+        self.emit(event)
+
+    def record_normalization(self, tokens: int, normalized_tokens: int) -> None:
+        """Tokens of a decision before and after layout normalization."""
+        self.emit({'type': 'normalize', 'tokens': tokens, 'normalized_tokens': normalized_tokens})
+
+    @contextmanager
+    def stage(self, name: str, **fields: Any) -> Iterator[None]:
+        """Time a pipeline stage (chunking, sections, reduce, conclusion, write, ...)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.emit({'type': 'stage', 'stage': name, 'duration': round(time.perf_counter() - started, 4), **fields})
+
+    def write_snapshot(self, path: str = None) -> str:
+        path = path or os.path.join(self.metrics_dir, SNAPSHOT_FILE)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(self.metrics.prometheus())
+        return path
+
+    def summary(self) -> str:
+        totals = self.metrics.totals()
+        return (f"{int(totals['requests'])} LLM calls ({int(totals['cache_hits'])} cached), "
+                f"{int(totals['prompt_tokens'])} prompt + {int(totals['completion_tokens'])} completion tokens, "
+                f"${totals['cost']:.4f}")
+
+
+def metrics_from_traces(trace_path: str) -> Metrics:
+    """Rebuild the totals of every run recorded in a trace file, e.g. after a batch run."""
+    metrics = Metrics()
+    with open(trace_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                metrics.add(json.loads(line))
+            except (json.JSONDecodeError, KeyError):
+                continue  # half-written line from an interrupted run
+    return metrics
+
+
+_default_recorder = None
+
+
+def default_recorder() -> Recorder:
+    global _default_recorder
+    if _default_recorder is None:
+        _default_recorder = Recorder()
+    return _default_recorder
+
+
+def write_snapshot_from_traces(metrics_dir: str = METRICS_DIR) -> Metrics:
+    metrics = metrics_from_traces(os.path.join(metrics_dir, TRACE_FILE))
+    with open(os.path.join(metrics_dir, SNAPSHOT_FILE), 'w', encoding='utf-8') as file:
+        file.write(metrics.prometheus())
+    return metrics
+
+
+def main():
+    totals = write_snapshot_from_traces().totals()
+    print(f"Metrics of {os.path.join(METRICS_DIR, TRACE_FILE)} written to {os.path.join(METRICS_DIR, SNAPSHOT_FILE)}")
+    print(f"{int(totals['requests'])} LLM calls, {int(totals['prompt_tokens'])} prompt + "
+          f"{int(totals['completion_tokens'])} completion tokens, ${totals['cost']:.4f}")
+
+
+if __name__ == '__main__':
+    main()
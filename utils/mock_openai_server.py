@@ -0,0 +1,246 @@
+"""Local stand-in for the OpenAI chat completions endpoint.
+
+Answers POST /v1/chat/completions (plain and streamed) with filler Greek text after a
+configurable latency, at a configurable generation speed, and fails a configurable
+share of the requests. Optional requests- and tokens-per-minute limits answer 429 like
+the real API and report x-ratelimit-* headers. GET /stats returns the request and token
+counters and POST /stats/reset clears them. Point the OpenAI clients at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Tuple
+
+FILLER_WORDS = ('η', 'απόφαση', 'του', 'δικαστηρίου', 'κρίνει', 'ότι', 'ο', 'νόμος', 'εφαρμόζεται', 'στην', 'υπόθεση')
+
+
+@dataclass
+class MockConfig:
+    latency: float = 0.5  # seconds before the first token
+    jitter: float = 0.1  # uniform extra latency, in seconds
+    tokens_per_second: float = 0.0  # generation speed, 0 = instant
+    failure_rate: float = 0.0  # share of requests answered with an error
+    failure_status: int = 500  # 429 exercises rate-limit handling
+    response_tokens: int = 200  # completion length, capped by max_tokens
+    rpm_limit: int = 0  # requests per minute before answering 429, 0 = unlimited
+    tpm_limit: int = 0  # tokens (prompt + max_tokens) per minute before answering 429, 0 = unlimited
+
+
+class MockStats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.requests = 0
+            self.failures = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.rate_limited = 0
+            self.refilled = time.monotonic()
+            self.request_level = self.token_level = float('inf')  # capped to the limits on the first request
+
+    def as_dict(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'failures': self.failures,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'max_in_flight': self.max_in_flight,
+                'rate_limited': self.rate_limited,
+            }
+
+    def admit(self, tokens: int, config: MockConfig) -> Tuple[bool, Dict[str, str]]:
+        """Take a request and its tokens from the per-minute limits, which refill continuously like the API's.
+
+        Returns whether the request is admitted and the x-ratelimit-* headers to send.
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed, self.refilled = now - self.refilled, now
+            self.request_level = min(config.rpm_limit, self.request_level + elapsed * config.rpm_limit / 60)
+            self.token_level = min(config.tpm_limit, self.token_level + elapsed * config.tpm_limit / 60)
+            admitted = (not config.rpm_limit or self.request_level >= 1) and (not config.tpm_limit or self.token_level >= tokens)
+            if admitted:
+                self.request_level -= 1
+                self.token_level -= tokens
+            else:
+                self.rate_limited += 1
+            headers = {}
+            if config.rpm_limit:
+                headers['x-ratelimit-limit-requests'] = str(config.rpm_limit)
+                headers['x-ratelimit-remaining-requests'] = str(max(0, int(self.request_level)))
+            if config.tpm_limit:
+                headers['x-ratelimit-limit-tokens'] = str(config.tpm_limit)
+                headers['x-ratelimit-remaining-tokens'] = str(max(0, int(self.token_level)))
+            return admitted, headers
+
+
+def count_prompt_tokens(messages) -> int:
+    text = ''.join(message.get('content') or '' for message in messages)
+    try:
+        from utils.chunking import TokenEstimator
+        return TokenEstimator('gpt-3.5-turbo').estimate(text)
+    except Exception:
+        return len(text) // 3  # no tokenizer available, rough estimate
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    server: 'MockOpenAIServer'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Dict[str, str] = None) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip('/').endswith('/stats'):
+            self._send_json(200, self.server.stats.as_dict())
+        else:
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if self.path.rstrip('/').endswith('/stats/reset'):
+            self.server.stats.reset()
+            self._send_json(200, {})
+            return
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+
+        stats, config = self.server.stats, self.server.config
+        with stats.lock:
+            stats.requests += 1
+            stats.in_flight += 1
+            stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+        try:
+            self._complete(request, config, stats)
+        finally:
+            with stats.lock:
+                stats.in_flight -= 1
+
+    def _complete(self, request: Dict[str, Any], config: MockConfig, stats: MockStats) -> None:
+        time.sleep(config.latency + random.uniform(0, config.jitter))
+        if random.random() < config.failure_rate:
+            with stats.lock:
+                stats.failures += 1
+            self._send_json(config.failure_status, {'error': {'message': 'Simulated failure', 'type': 'mock_error'}},
+                            {'retry-after': '1'} if config.failure_status == 429 else None)
+            return
+
+        prompt_tokens = count_prompt_tokens(request.get('messages', []))
+        completion_tokens = min(config.response_tokens, request.get('max_tokens') or config.response_tokens)
+        admitted, rate_headers = stats.admit(prompt_tokens + (request.get('max_tokens') or completion_tokens), config)
+        if not admitted:
+            self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                            {**rate_headers, 'retry-after': '1'})
+            return
+        words = [random.choice(FILLER_WORDS) for _ in range(completion_tokens)]
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                 'total_tokens': prompt_tokens + completion_tokens}
+        with stats.lock:
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+
+        meta = {'id': f'chatcmpl-{uuid.uuid4().hex}', 'created': int(time.time()), 'model': request.get('model', 'mock')}
+        delay = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+        if not request.get('stream'):
+            time.sleep(delay * completion_tokens)
+            self._send_json(200, {
+                **meta, 'object': 'chat.completion', 'usage': usage,
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': ' '.join(words)}}],
+            }, rate_headers)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in rate_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        def send_event(payload) -> None:
+            data = f'data: {payload}\n\n'.encode('utf-8')
+            self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+            self.wfile.flush()
+
+        chunk = {**meta, 'object': 'chat.completion.chunk'}
+        for idx, word in enumerate(words):
+            time.sleep(delay)
+            delta = {'role': 'assistant', 'content': word} if idx == 0 else {'content': f' {word}'}
+            send_event(json.dumps({**chunk, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]}, ensure_ascii=False))
+        send_event(json.dumps({**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            send_event(json.dumps({**chunk, 'choices': [], 'usage': usage}))
+        send_event('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # accept bursts of concurrent connections
+
+    def __init__(self, address: Tuple[str, int], config: MockConfig) -> None:
+        super().__init__(address, MockHandler)
+        self.config = config
+        self.stats = MockStats()
+
+    def handle_error(self, request, client_address) -> None:
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)  # clients closing their pooled connections is not an error
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+
+def start_mock_server(config: MockConfig = None, host: str = '127.0.0.1', port: int = 0) -> MockOpenAIServer:
+    """Start the server on a background thread (port 0 picks a free port). Stop it with shutdown()."""
+    server = MockOpenAIServer((host, port), config or MockConfig())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the OpenAI chat completions API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    defaults = MockConfig()
+    for field, value in asdict(defaults).items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+
+    config = MockConfig(**{field: getattr(args, field) for field in asdict(defaults)})
+    server = MockOpenAIServer((args.host, args.port), config)
+    print(f'Mock OpenAI server on {server.base_url} ({config})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
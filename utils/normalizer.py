@@ -0,0 +1,297 @@
+"""Layout normalization of the decisions before they are tokenized and sent to the API.
+
+The text files and the annotated sections keep the layout of the court's documents:
+indentation and padding spaces around centered headers, tabs after paragraph numbers,
+line breaks inside paragraphs, letter-spaced formulas (``Δ ι ά  τ α ύ τ α``) and dotted
+placeholders of anonymized names. All of it costs tokens and none of it is content.
+The normalizer collects the words of a decision in a first pass and then normalizes it
+one paragraph at a time:
+
+- collapses every whitespace run to one space and keeps paragraph breaks as a blank line,
+- joins words broken at the end of a line: the hyphen is dropped only when the joined
+  word occurs elsewhere in the decision, otherwise it is kept (``ανδρών-νέων``, ``2020-2021``),
+- joins letter-spaced words when wider gaps show where the words end (otherwise the
+  words cannot be told apart and the text is left as it is),
+- shortens placeholder runs of dots (``……….``) to one ellipsis and drops soft hyphens.
+
+Every character of the result maps back to the span of the original text it was made
+from; span_index.align_sections uses the map to find annotated sections in the text files
+whatever their layout. The token counts of the original and normalized document and of
+every section are kept in a sidecar file per decision (.cache/token_index/<decision>.json),
+which TokenEstimator lookups are answered from, so planning the same decision again
+tokenizes nothing:
+
+    python -m utils.normalizer            # tokens saved per decision
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import tempfile
+from os.path import join, splitext
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Sequence, Set, Tuple
+
+import numpy as np
+
+from utils.chunking import TokenEstimator
+
+INDEX_DIR = join('.cache', 'token_index')
+TXT_FOLDER = join('documents', 'txt_files')
+PARAGRAPH_BREAK = '\n\n'
+PLACEHOLDER = '…'
+
+_LETTER = r'[^\W\d_]'
+_WORD = re.compile(rf'{_LETTER}+')
+_ALNUM = re.compile(r'[^\W_]+')
+_LAYOUT = re.compile(
+    r'(?P<invisible>[\u00ad\u200b-\u200d\u2060\ufeff]+)'
+    r'|(?<=[^\W_])(?P<hyphen>-[ \t]*\n[ \t]*)(?=[^\W_])'
+    rf'|(?<!\S)(?P<spaced>{_LETTER}(?:[ \t]+{_LETTER}){{3,}})(?!\S)'
+    r'|(?P<placeholder>[.…]{4,})'
+    r'|(?P<space>\s+)'
+)
+_WORD_GAP = re.compile(r'[ \t]{2,}')
+
+
+class Normalized(NamedTuple):
+    text: str
+    starts: np.ndarray  # for every character of text, the start of the original text it was made from
+    ends: np.ndarray  # and the end of it (a collapsed whitespace run or placeholder covers the whole run)
+
+    def original_span(self, start: int, end: int) -> Tuple[int, int]:
+        """Span of the original text that text[start:end] was made from."""
+        if end <= start:
+            offset = int(self.starts[start]) if start < len(self.text) else int(self.ends[-1]) if len(self.text) else 0
+            return offset, offset
+        return int(self.starts[start]), int(self.ends[end - 1])
+
+
+def vocabulary_of(texts: Iterable[str]) -> Set[str]:
+    """Lowercase words of a decision, which decide whether a hyphen at a line break is dropped."""
+    return {word.lower() for text in texts for word in _WORD.findall(text)}
+
+
+def _normalize_paragraph(raw: str, base: int, vocabulary: Set[str]) -> Tuple[str, List[int], List[int]]:
+    chars: List[str] = []
+    starts: List[int] = []
+    ends: List[int] = []
+
+    def emit(char: str, start: int, end: int) -> None:
+        chars.append(char)
+        starts.append(base + start)
+        ends.append(base + end)
+
+    def keep(start: int, end: int) -> None:
+        chars.extend(raw[start:end])
+        starts.extend(range(base + start, base + end))
+        ends.extend(range(base + start + 1, base + end + 1))
+
+    position = 0
+    for match in _LAYOUT.finditer(raw):
+        keep(position, match.start())
+        position = match.end()
+        kind = match.lastgroup
+        if kind == 'space':
+            if chars and match.end() < len(raw):
+                emit(' ', match.start(), match.end())
+        elif kind == 'hyphen':
+            before = _ALNUM.findall(raw, 0, match.start())[-1]
+            after = _ALNUM.match(raw, match.end()).group()
+            joined = before + after
+            if not (joined.isalpha() and joined.lower() in vocabulary):
+                emit('-', match.start(), match.start() + 1)
+        elif kind == 'spaced':
+            words = _split_words(match)
+            if len(words) < 2:
+                keep(match.start(), match.end())  # no visible word boundaries
+                continue
+            previous_end = None
+            for word_start, word in words:
+                if previous_end is not None:
+                    emit(' ', previous_end, word_start)
+                for letter in re.finditer(r'\S', word):
+                    emit(letter.group(), word_start + letter.start(), word_start + letter.end())
+                previous_end = word_start + len(word)
+        elif kind == 'placeholder':
+            emit(PLACEHOLDER, match.start(), match.end())
+    keep(position, len(raw))
+    return ''.join(chars), starts, ends
+
+
+def _split_words(match: re.Match) -> List[Tuple[int, str]]:
+    """(start, word) of the letter-spaced words of a match, split at the gaps of two or more spaces."""
+    words, start = [], match.start()
+    for gap in _WORD_GAP.finditer(match.string, match.start(), match.end()):
+        words.append((start, match.string[start:gap.start()]))
+        start = gap.end()
+    words.append((start, match.string[start:match.end()]))
+    return words
+
+
+def normalized_paragraphs(lines: Iterable[str], vocabulary: Set[str]) -> Iterator[Tuple[str, List[int], List[int]]]:
+    """Normalize a document line by line; yields (paragraph, original start and end of every character).
+
+    vocabulary holds the words of the whole decision (vocabulary_of), so whether a
+    hyphen is dropped does not depend on where else in the decision the word occurs.
+    """
+    paragraph: List[str] = []
+    start = offset = 0
+    for line in lines:
+        if line.strip():
+            if not paragraph:
+                start = offset
+            paragraph.append(line)
+        elif paragraph:
+            text, starts, ends = _normalize_paragraph(''.join(paragraph), start, vocabulary)
+            paragraph = []
+            if text:
+                yield text, starts, ends
+        offset += len(line)
+    if paragraph:
+        text, starts, ends = _normalize_paragraph(''.join(paragraph), start, vocabulary)
+        if text:
+            yield text, starts, ends
+
+
+def normalize_lines(lines: Sequence[str], vocabulary: Set[str] = None, paragraph_break: str = PARAGRAPH_BREAK) -> Normalized:
+    """Normalize the lines of a decision: a first pass collects its vocabulary, a second one normalizes it."""
+    if vocabulary is None:
+        vocabulary = vocabulary_of(lines)
+    parts: List[str] = []
+    starts: List[int] = []
+    ends: List[int] = []
+    for text, paragraph_starts, paragraph_ends in normalized_paragraphs(lines, vocabulary):
+        if parts:
+            # The break stands for the blank lines between the two paragraphs
+            parts.append(paragraph_break)
+            starts.extend([ends[-1]] * len(paragraph_break))
+            ends.extend([paragraph_starts[0]] * len(paragraph_break))
+        parts.append(text)
+        starts.extend(paragraph_starts)
+        ends.extend(paragraph_ends)
+    return Normalized(''.join(parts), np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+
+
+def normalize_text(text: str, vocabulary: Set[str] = None, paragraph_break: str = PARAGRAPH_BREAK) -> Normalized:
+    return normalize_lines(text.splitlines(keepends=True), vocabulary, paragraph_break)
+
+
+def normalize_file(path: str) -> Normalized:
+    with open(path, 'r', encoding='utf-8') as file:
+        return normalize_lines(file.readlines())
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class IndexedTokenEstimator(TokenEstimator):
+    """TokenEstimator that answers from the counts of a token index and adds the ones it computes."""
+
+    def __init__(self, model: str, counts: Dict[str, int]) -> None:
+        super().__init__(model)
+        self.counts = counts
+        self.computed = 0
+
+    def estimate(self, text: str) -> int:
+        key = _digest(text)
+        if key not in self.counts:
+            self.counts[key] = super().estimate(text)
+            self.computed += 1
+        return self.counts[key]
+
+
+class TokenIndex:
+    """Sidecar token counts of one decision: per document kind ('text', 'sections') and per text."""
+
+    def __init__(self, decision_number: str, index_dir: str = INDEX_DIR) -> None:
+        self.path = join(index_dir, f'{decision_number}.json')
+        self.data: Dict[str, Any] = {'documents': {}, 'counts': {}}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as file:
+                self.data = json.load(file)
+        self.estimators: Dict[str, IndexedTokenEstimator] = {}
+
+    def estimator(self, model: str) -> IndexedTokenEstimator:
+        if model not in self.estimators:
+            estimator = IndexedTokenEstimator(model, {})
+            # Models that share an encoding share the counts
+            estimator.counts = self.data['counts'].setdefault(estimator.encoding.name, {})
+            self.estimators[model] = estimator
+        return self.estimators[model]
+
+    def document(self, kind: str, original: Sequence[str], normalized: Sequence[str],
+                 estimator: IndexedTokenEstimator) -> Dict[str, Any]:
+        """Token counts of a document before and after normalization, computed once per source."""
+        source = _digest('\x00'.join(original))
+        entry = self.data['documents'].get(kind)
+        if entry is None or entry['source'] != source or entry['encoding'] != estimator.encoding.name:
+            sections = [estimator.estimate(text) for text in normalized]
+            entry = {
+                'source': source,
+                'encoding': estimator.encoding.name,
+                'tokens': sum(estimator.estimate(text) for text in original),
+                'normalized_tokens': sum(sections),
+                'sections': sections,
+            }
+            self.data['documents'][kind] = entry
+        return entry
+
+    def save(self) -> None:
+        """Write the index if anything was counted since it was loaded; the file is replaced atomically."""
+        if os.path.exists(self.path) and not any(estimator.computed for estimator in self.estimators.values()):
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(self.data, file)
+        os.replace(tmp_path, self.path)
+        for estimator in self.estimators.values():
+            estimator.computed = 0
+
+
+def normalize_decision_text(decision_number: str, path: str, model: str = 'gpt-3.5-turbo',
+                            index_dir: str = INDEX_DIR) -> Tuple[Normalized, Dict[str, Any], TokenIndex]:
+    """Normalized text file of a decision with its token counts (from the sidecar when the file is unchanged)."""
+    with open(path, 'r', encoding='utf-8') as file:
+        original = file.read()
+    normalized = normalize_text(original)
+    token_index = TokenIndex(decision_number, index_dir)
+    counts = token_index.document('text', [original], [normalized.text], token_index.estimator(model))
+    token_index.save()
+    return normalized, counts, token_index
+
+
+def normalize_sections(decision_number: str, sections: Sequence[Dict[str, Any]], model: str = 'gpt-4',
+                       index_dir: str = INDEX_DIR) -> Tuple[List[Dict[str, Any]], Dict[str, Any], TokenIndex]:
+    """Annotated sections with normalized texts and their token counts; sections left empty are dropped."""
+    sections = list(sections)
+    vocabulary = vocabulary_of(section['text'] for section in sections)
+    normalized = [normalize_text(section['text'], vocabulary).text for section in sections]
+    token_index = TokenIndex(decision_number, index_dir)
+    counts = token_index.document('sections', [section['text'] for section in sections], normalized,
+                                  token_index.estimator(model))
+    token_index.save()
+    return [{**section, 'text': text} for section, text in zip(sections, normalized) if text], counts, token_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Normalize the decisions and report the tokens saved.')
+    parser.add_argument('decisions', nargs='*', help='decision numbers (default: every decision of documents/txt_files)')
+    args = parser.parse_args()
+
+    decisions = args.decisions or sorted(splitext(name)[0] for name in os.listdir(TXT_FOLDER) if name.endswith('.txt'))
+    total_before = total_after = 0
+    for decision_number in decisions:
+        _, counts, _ = normalize_decision_text(decision_number, join(TXT_FOLDER, f'{decision_number}.txt'))
+        saved = counts['tokens'] - counts['normalized_tokens']
+        total_before += counts['tokens']
+        total_after += counts['normalized_tokens']
+        print(f"{decision_number}: {counts['tokens']} -> {counts['normalized_tokens']} tokens "
+              f"({saved} saved, {saved / max(counts['tokens'], 1):.1%})")
+    print(f'Total: {total_before} -> {total_after} tokens ({total_before - total_after} saved)')
+
+
+if __name__ == '__main__':
+    main()
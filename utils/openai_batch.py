@@ -0,0 +1,276 @@
+"""Offline summarization of many decisions through the OpenAI Batch API.
+
+The pipelines run in waves. ``prepare`` writes every request that can be made now
+(sections and chunks in the first wave, reduce levels and conclusions in later waves) to
+documents/batch/requests.jsonl in the Batch API format, with stable custom_ids such as
+``ste_2325-2023:structured:section:3``. ``ingest`` reads the results file of a batch,
+stores every answer and prepares the next wave. Decisions whose
+requests are all answered are written to documents/my_summaries and
+documents/plain_summaries, exactly as the online pipelines would write them.
+
+The response cache evicts its least recently used entries, so the ingested answers are
+also appended to documents/batch/answers.jsonl, which is never evicted and is read
+before the cache: a request that was paid for once is never sent in a later wave.
+
+    python -m utils.openai_batch prepare
+    python -m utils.openai_batch submit            # or upload requests.jsonl by hand
+    python -m utils.openai_batch fetch <batch id>
+    python -m utils.openai_batch ingest documents/batch/results-<batch id>.jsonl
+"""
+import argparse
+import json
+import os
+from os.path import join, splitext
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from utils.chunking import TokenEstimator
+from utils.llm_cache import ResponseCache, default_cache
+from utils.tree_reduce import group_adjacent, needs_another_level
+
+BATCH_FOLDER = join('documents', 'batch')
+REQUESTS_PATH = join(BATCH_FOLDER, 'requests.jsonl')
+ANSWERS_PATH = join(BATCH_FOLDER, 'answers.jsonl')
+ANNOTATED_FOLDER = join('documents', 'annotated_decisions')
+TXT_FOLDER = join('documents', 'txt_files')
+STRUCTURED_OUTPUT_FOLDER = join('documents', 'my_summaries')
+PLAIN_OUTPUT_FOLDER = join('documents', 'plain_summaries')
+PIPELINES = ('structured', 'plain')
+ENDPOINT = '/v1/chat/completions'
+
+
+class BatchAnswers:
+    """Append-only store of every ingested batch answer, keyed like the response cache."""
+
+    def __init__(self, path: str = ANSWERS_PATH) -> None:
+        self.path = path
+        self.responses: Dict[str, Dict[str, Any]] = {}
+        self._terminated = True  # False if an interrupted ingest left the last line without its newline
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    self._terminated = line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # half-written line from an interrupted ingest
+                    self.responses[entry['key']] = entry['response']
+
+    def get(self, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return self.responses.get(ResponseCache.make_key(request))
+
+    def put(self, custom_id: str, request: Dict[str, Any], response: Dict[str, Any]) -> None:
+        key = ResponseCache.make_key(request)
+        if key in self.responses:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as file:
+            if not self._terminated:
+                file.write('\n')
+                self._terminated = True
+            file.write(json.dumps({'key': key, 'custom_id': custom_id, 'response': response}, ensure_ascii=False) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self.responses[key] = response
+
+
+class Wave:
+    """Answers requests from the batch answers or the response cache and collects the ones still to be sent."""
+
+    def __init__(self, cache: ResponseCache, answers: BatchAnswers) -> None:
+        self.cache = cache
+        self.answers = answers
+        self.pending: List[Dict[str, Any]] = []
+
+    def ask(self, custom_id: str, request: Dict[str, Any]) -> Optional[str]:
+        cached = self.answers.get(request) or self.cache.get(request)
+        if cached is not None:
+            return cached['choices'][0]['message']['content']
+        self.pending.append({'custom_id': custom_id, 'method': 'POST', 'url': ENDPOINT, 'body': request})
+        return None
+
+
+def reduce_in_waves(wave: Wave, prefix: str, summaries: Sequence[str], request_for: Callable[[str], Dict[str, Any]],
+                    token_estimator: TokenEstimator, max_group_tokens: int, max_total_tokens: int) -> Optional[List[str]]:
+    """Same levels as tree_reduce.reduce_summaries, one wave per level; None until the last level is answered."""
+    summaries = list(summaries)
+    token_counts = [token_estimator.estimate(summary) for summary in summaries]
+    input_tokens, level = None, 0
+    while needs_another_level(sum(token_counts), input_tokens, max_total_tokens):
+        level += 1
+        groups = group_adjacent(summaries, token_counts, max_group_tokens, token_estimator)
+        reduced = [wave.ask(f'{prefix}:reduce:{level}:{idx}', request_for(group)) for idx, group in enumerate(groups)]
+        if None in reduced:
+            return None
+        reduced_counts = [token_estimator.estimate(summary) for summary in reduced]
+        if sum(reduced_counts) >= sum(token_counts):
+            break
+        summaries, token_counts, input_tokens = reduced, reduced_counts, sum(token_counts)
+    return summaries
+
+
+def structured_decision(wave: Wave, decision_number: str, output_folder: str) -> bool:
+    """Advance main.summarize_decision for one decision; True once its summary is written."""
+    import main
+    token_estimator = TokenEstimator()
+    prefix = f'{decision_number}:structured'
+    requests = main.plan_decision(decision_number, token_estimator)
+    summaries = [wave.ask(f'{prefix}:section:{idx}', main.section_request(request)) for idx, request in enumerate(requests)]
+    if None in summaries:
+        return False
+    merged_summary = ''.join(f' {summary}' for summary in summaries)
+    if token_estimator.estimate(merged_summary) > main.SAFE_TOKEN_LIMIT:
+        reduced = reduce_in_waves(wave, prefix, summaries, main.reduce_request, token_estimator,
+                                  main.REDUCE_GROUP_TOKENS, main.SAFE_TOKEN_LIMIT)
+        if reduced is None:
+            return False
+        merged_summary = ' '.join(reduced)
+    conclusion = wave.ask(f'{prefix}:conclusion', main.conclusion_request(merged_summary))
+    if conclusion is None:
+        return False
+    main.write_summary(output_folder, decision_number, merged_summary, conclusion)
+    return True
+
+
+def plain_decision(wave: Wave, decision_number: str, output_folder: str, temperature=0.7, max_chunk_tokens=2500,
+                   summary_tokens=700, max_total_tokens=13000) -> bool:
+    """Advance plain_summary.summarize_large_text for one decision; True once its summary is written."""
+    import plain_summary
+    prefix = f'{decision_number}:plain'
+
+    def request_for(text: str) -> Dict[str, Any]:
+        return plain_summary.chunk_request(text, plain_summary.PROMPT, temperature, summary_tokens)
+
+    chunks = plain_summary.read_chunks(decision_number, plain_summary.INPUT_FOLDER, max_chunk_tokens)
+    summaries = [wave.ask(f'{prefix}:chunk:{idx}', request_for(chunk)) for idx, chunk in enumerate(chunks)]
+    if None in summaries:
+        return False
+    summaries = reduce_in_waves(wave, prefix, summaries, request_for, TokenEstimator('gpt-3.5-turbo'),
+                                max_chunk_tokens, max_total_tokens)
+    if summaries is None:
+        return False
+    os.makedirs(output_folder, exist_ok=True)
+    with open(join(output_folder, f'{decision_number}.txt'), 'w', encoding='utf-8') as file:
+        file.write(''.join(summary + '\n\n' for summary in summaries))
+    return True
+
+
+def list_decisions(folder: str, extension: str) -> List[str]:
+    if not os.path.isdir(folder):
+        return []
+    return sorted(splitext(name)[0] for name in os.listdir(folder) if name.endswith(extension))
+
+
+def prepare(pipelines=PIPELINES, decisions: Sequence[str] = None, requests_path: str = REQUESTS_PATH,
+            cache: ResponseCache = None, answers: BatchAnswers = None) -> int:
+    """Write the next wave of requests and every summary that is complete. Returns the number of requests."""
+    wave = Wave(cache or default_cache(), answers or BatchAnswers())
+    jobs = []
+    if 'structured' in pipelines:
+        jobs += [(decision, structured_decision, STRUCTURED_OUTPUT_FOLDER)
+                 for decision in list_decisions(ANNOTATED_FOLDER, '.json') if not decisions or decision in decisions]
+    if 'plain' in pipelines:
+        jobs += [(decision, plain_decision, PLAIN_OUTPUT_FOLDER)
+                 for decision in list_decisions(TXT_FOLDER, '.txt') if not decisions or decision in decisions]
+
+    finished = 0
+    for decision_number, advance, output_folder in jobs:
+        if advance(wave, decision_number, output_folder):
+            finished += 1
+    os.makedirs(os.path.dirname(requests_path) or '.', exist_ok=True)
+    with open(requests_path, 'w', encoding='utf-8') as file:
+        for line in wave.pending:
+            file.write(json.dumps(line, ensure_ascii=False) + '\n')
+    print(f'{finished} of {len(jobs)} summaries complete, {len(wave.pending)} requests written to {requests_path}')
+    return len(wave.pending)
+
+
+def ingest(results_path: str, requests_path: str = REQUESTS_PATH, cache: ResponseCache = None,
+           answers: BatchAnswers = None) -> int:
+    """Store the answers of a batch results file in the batch answers and the response cache. Returns the number stored."""
+    cache = cache or default_cache()
+    answers = answers or BatchAnswers()
+    with open(requests_path, 'r', encoding='utf-8') as file:
+        requests = {line['custom_id']: line['body'] for line in map(json.loads, file)}
+    stored, failed = 0, []
+    with open(results_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            result = json.loads(line)
+            response = result.get('response') or {}
+            request = requests.get(result['custom_id'])
+            if request is None:
+                failed.append(f"{result['custom_id']}: not in {requests_path}")
+            elif result.get('error') or response.get('status_code') != 200:
+                failed.append(f"{result['custom_id']}: {result.get('error') or response.get('body')}")
+            else:
+                answers.put(result['custom_id'], request, response['body'])
+                cache.put(request, response['body'])  # the online pipelines can reuse it too
+                stored += 1
+    print(f'{stored} results stored, {len(failed)} failed (they are sent again in the next wave)')
+    for failure in failed:
+        print(f'  {failure}')
+    return stored
+
+
+def _check_batches_api(client) -> None:
+    if not hasattr(client, 'batches'):
+        import openai
+        raise RuntimeError(f'openai {openai.__version__} has no Batch API; install the version in requirements.txt')
+
+
+def submit(client, requests_path: str = REQUESTS_PATH) -> str:
+    _check_batches_api(client)
+    with open(requests_path, 'rb') as file:
+        batch_file = client.files.create(file=file, purpose='batch')
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint=ENDPOINT, completion_window='24h')
+    print(f'Batch {batch.id} submitted ({batch.status})')
+    return batch.id
+
+
+def fetch(client, batch_id: str) -> Optional[str]:
+    """Download the results of a finished batch to documents/batch/results-<batch id>.jsonl."""
+    _check_batches_api(client)
+    batch = client.batches.retrieve(batch_id)
+    print(f'Batch {batch_id}: {batch.status} {batch.request_counts}')
+    if batch.status != 'completed':
+        return None
+    results_path = join(BATCH_FOLDER, f'results-{batch_id}.jsonl')
+    with open(results_path, 'w', encoding='utf-8') as file:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                file.write(client.files.content(file_id).text)
+    print(f'Results written to {results_path}')
+    return results_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize decisions in waves through the OpenAI Batch API.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    prepare_parser = subparsers.add_parser('prepare', help='write the next wave of requests')
+    prepare_parser.add_argument('decisions', nargs='*', help='decision numbers (default: the whole corpus)')
+    prepare_parser.add_argument('--pipeline', choices=PIPELINES, action='append', help='pipelines to run (default: all)')
+    subparsers.add_parser('submit', help=f'upload {REQUESTS_PATH} and create a batch')
+    fetch_parser = subparsers.add_parser('fetch', help='download the results of a finished batch')
+    fetch_parser.add_argument('batch_id')
+    ingest_parser = subparsers.add_parser('ingest', help='store a results file and prepare the next wave')
+    ingest_parser.add_argument('results_path')
+    ingest_parser.add_argument('decisions', nargs='*', help='decision numbers (default: the whole corpus)')
+    ingest_parser.add_argument('--pipeline', choices=PIPELINES, action='append', help='pipelines to run (default: all)')
+    args = parser.parse_args()
+
+    if args.command in ('submit', 'fetch'):
+        from dotenv import load_dotenv
+        from openai import OpenAI
+        load_dotenv()
+        client = OpenAI(api_key=os.getenv('OPENAI_KEY'))
+        if args.command == 'submit':
+            submit(client)
+        else:
+            fetch(client, args.batch_id)
+        return
+    if args.command == 'ingest':
+        ingest(args.results_path)
+    prepare(tuple(args.pipeline or PIPELINES), args.decisions)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""Shared throttling and retrying for every chat completion request.
+
+A RateGovernor keeps requests-per-minute and tokens-per-minute token buckets. Every
+request reserves one request and its estimated tokens (prompt estimated with
+TokenEstimator plus max_tokens, as OpenAI counts them) before it is sent. The buckets
+are corrected from the x-ratelimit-* headers of every response and refunded with the
+usage the API reports. Concurrency is adjusted with AIMD: it grows by one after a
+window of successful requests and is halved on every 429. Rate limits, timeouts,
+connection errors and 5xx responses are retried with jittered exponential backoff.
+
+Limits come from the response headers; OPENAI_RPM, OPENAI_TPM and
+OPENAI_MAX_CONCURRENCY set the starting values. The buckets live in one process, so
+a pool of N processes that call the API at once (batch.py) gives every process a
+governor with 1/N of the limits and of the concurrency (share_default_governor).
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from utils.chunking import TokenEstimator
+
+MAX_RETRIES = 6
+BASE_DELAY = 1.0  # seconds, doubled on every retry
+MAX_DELAY = 60.0
+POLL_INTERVAL = 0.05  # seconds between checks while waiting for capacity
+
+
+@lru_cache(maxsize=None)
+def retryable_errors() -> Tuple[type, ...]:
+    """Rate limits, timeouts, connection errors and 5xx responses (openai is only imported when a request is made)."""
+    import openai
+    return openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError
+
+
+def _is_rate_limit(error: Exception) -> bool:
+    return isinstance(error, retryable_errors()[0])
+
+
+class TokenBucket:
+    """Capacity that refills linearly to ``limit`` within one minute. Not thread-safe on its own."""
+
+    def __init__(self, limit: Optional[float]) -> None:
+        self.limit = limit
+        self.level = limit
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.limit is not None:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount is available (0 if it is available now)."""
+        self._refill()
+        if self.limit is None or self.level >= min(amount, self.limit):
+            return 0.0
+        return (min(amount, self.limit) - self.level) * 60 / self.limit
+
+    def take(self, amount: float) -> None:
+        if self.limit is not None:
+            self.level -= amount
+
+    def update(self, limit: Optional[float], remaining: Optional[float]) -> None:
+        """Adopt the limit and the remaining capacity reported by the API."""
+        self._refill()
+        if limit:
+            if self.limit is None:
+                self.level = limit
+            self.limit = limit
+        if remaining is not None and self.limit is not None:
+            self.level = min(self.level, remaining)
+
+
+class RateGovernor:
+    def __init__(self, rpm: float = None, tpm: float = None, max_concurrency: int = 8, min_concurrency: int = 1,
+                 share: float = 1.0) -> None:
+        self.share = share  # fraction of the account limits this governor may use
+        self.requests = TokenBucket(self._shared(rpm))
+        self.tokens = TokenBucket(self._shared(tpm))
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.estimators: Dict[str, TokenEstimator] = {}
+        self.retries = 0
+        self.throttled = 0
+
+    def _shared(self, value: Optional[float]) -> Optional[float]:
+        return value * self.share if value is not None else None
+
+    def estimate_tokens(self, request: Dict[str, Any]) -> int:
+        model = request.get('model', 'gpt-3.5-turbo')
+        if model not in self.estimators:
+            try:
+                self.estimators[model] = TokenEstimator(model)
+            except KeyError:  # model unknown to tiktoken
+                self.estimators[model] = TokenEstimator('gpt-4')
+        estimator = self.estimators[model]
+        prompt = sum(estimator.estimate(message.get('content') or '') + 4 for message in request.get('messages', []))
+        return prompt + (request.get('max_tokens') or 0)
+
+    # Capacity
+
+    def _try_acquire(self, tokens: int) -> float:
+        """Reserve a slot, one request and the tokens, or return how long to wait before trying again."""
+        with self.lock:
+            if self.in_flight >= int(self.concurrency):
+                return POLL_INTERVAL
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait > 0:
+                return max(wait, POLL_INTERVAL)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.in_flight += 1
+            return 0.0
+
+    def acquire(self, tokens: int) -> None:
+        while (wait := self._try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int) -> None:
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def release(self, estimated_tokens: int, headers=None, usage=None, rate_limited: bool = False) -> None:
+        with self.lock:
+            self.in_flight -= 1
+            if headers is not None:
+                # The limits are the account's; the remaining capacity is what all processes left
+                self.requests.update(self._shared(_header_number(headers, 'x-ratelimit-limit-requests')),
+                                     _header_number(headers, 'x-ratelimit-remaining-requests'))
+                self.tokens.update(self._shared(_header_number(headers, 'x-ratelimit-limit-tokens')),
+                                   _header_number(headers, 'x-ratelimit-remaining-tokens'))
+            if usage is not None and self.tokens.limit is not None:
+                # Give back what the estimate reserved beyond the real usage
+                self.tokens.level = min(self.tokens.limit, self.tokens.level + max(0, estimated_tokens - usage.total_tokens))
+            if rate_limited:
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                self.throttled += 1
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / max(self.concurrency, 1))
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """Full-jitter exponential backoff, at least the retry-after the API asked for."""
+        delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+        response = getattr(error, 'response', None)
+        retry_after = _header_number(response.headers, 'retry-after') if response is not None else None
+        return max(delay, retry_after or 0)
+
+    # Requests
+
+    def create(self, client, request: Dict[str, Any], consume: Callable[[Any], Any] = None):
+        """``client.chat.completions.create(**request)`` within the limits, with retries.
+
+        consume turns the parsed response into the result (e.g. reads a stream); the
+        request keeps its concurrency slot until it is done and is retried if it fails.
+        """
+        client = _without_sdk_retries(client)
+        estimated = self.estimate_tokens(request)
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire(estimated)
+            try:
+                raw = client.chat.completions.with_raw_response.create(**request)
+                parsed = raw.parse()
+                result = consume(parsed) if consume else parsed
+            except retryable_errors() as e:
+                self.release(estimated, _error_headers(e), rate_limited=_is_rate_limit(e))
+                if attempt == MAX_RETRIES:
+                    raise
+                time.sleep(self._retry_delay(attempt, e))
+                continue
+            except BaseException:
+                self.release(estimated)
+                raise
+            self.release(estimated, raw.headers, _usage_of(result))
+            return result
+
+    async def create_async(self, client, request: Dict[str, Any], consume: Callable[[Any], Awaitable[Any]] = None):
+        """Async counterpart of create for AsyncOpenAI clients; consume is a coroutine function."""
+        client = _without_sdk_retries(client)
+        estimated = self.estimate_tokens(request)
+        for attempt in range(MAX_RETRIES + 1):
+            await self.acquire_async(estimated)
+            try:
+                raw = await client.chat.completions.with_raw_response.create(**request)
+                parsed = raw.parse()  # with_raw_response parses synchronously, also for async clients
+                result = await consume(parsed) if consume else parsed
+            except retryable_errors() as e:
+                self.release(estimated, _error_headers(e), rate_limited=_is_rate_limit(e))
+                if attempt == MAX_RETRIES:
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt, e))
+                continue
+            except BaseException:
+                self.release(estimated)
+                raise
+            self.release(estimated, raw.headers, _usage_of(result))
+            return result
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        with self.lock:
+            self.retries += 1
+        delay = self.backoff(attempt, error)
+        print(f'{type(error).__name__}, retry {attempt + 1} of {MAX_RETRIES} in {delay:.1f}s (concurrency {int(self.concurrency)})')
+        return delay
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'concurrency': int(self.concurrency),
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'rpm_limit': self.requests.limit,
+            'tpm_limit': self.tokens.limit,
+        }
+
+
+def _header_number(headers, name: str) -> Optional[float]:
+    value = headers.get(name) if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _usage_of(result):
+    response = result[0] if isinstance(result, tuple) else result  # (response, stream stats) of a consumed stream
+    return getattr(response, 'usage', None)
+
+
+def _error_headers(error: Exception):
+    response = getattr(error, 'response', None)
+    return response.headers if response is not None else None
+
+
+def _without_sdk_retries(client):
+    # The governor retries on its own; the module-level openai client has no with_options
+    with_options = getattr(client, 'with_options', None)
+    return with_options(max_retries=0) if with_options else client
+
+
+def _env_number(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+_default_governor = None
+
+
+def _governor_from_env(processes: int = 1) -> RateGovernor:
+    max_concurrency = int(os.getenv('OPENAI_MAX_CONCURRENCY', '8'))
+    return RateGovernor(_env_number('OPENAI_RPM'), _env_number('OPENAI_TPM'), max(1, max_concurrency // processes),
+                        share=1 / processes)
+
+
+def default_governor() -> RateGovernor:
+    global _default_governor
+    if _default_governor is None:
+        _default_governor = _governor_from_env()
+    return _default_governor
+
+
+def share_default_governor(processes: int) -> RateGovernor:
+    """Limit this process to 1/processes of the rate limits; called in every worker of a process pool."""
+    global _default_governor
+    _default_governor = _governor_from_env(max(1, processes))
+    return _default_governor
@@ -0,0 +1,88 @@
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence, Tuple
+
+from utils.chunking import TokenEstimator, plan_chunks
+
+SMALL_SECTION_TOKENS = 500  # Sections below this size are packed with their neighbours
+PACK_TOKENS = 3000  # Maximum input size of a packed request
+MIN_OUTPUT_TOKENS = 150
+MAX_OUTPUT_TOKENS = 1000
+MESSAGE_OVERHEAD_TOKENS = 16  # Role markers and separators of the chat format
+
+
+class PlannedRequest(NamedTuple):
+    section_indices: Tuple[int, ...]
+    class_name: str
+    text: str
+    input_tokens: int
+    max_tokens: int
+
+
+def class_name_of(section: Dict[str, Any], annotation_mappings: Dict[str, Any]) -> str:
+    return section.get('name') or annotation_mappings.get(section.get('class_id'), {}).get('name', 'other')
+
+
+def output_budget(importance: float, max_importance: float, input_tokens: int) -> int:
+    """Output tokens proportional to the class importance, never more than the input itself."""
+    share = importance / max_importance if max_importance > 0 else 0.0
+    budget = int(MIN_OUTPUT_TOKENS + (MAX_OUTPUT_TOKENS - MIN_OUTPUT_TOKENS) * share)
+    return max(MIN_OUTPUT_TOKENS, min(budget, input_tokens))
+
+
+def plan_requests(
+        sections: Sequence[Dict[str, Any]],
+        annotation_mappings: Dict[str, Any],
+        token_estimator: TokenEstimator,
+        parameters_for: Callable[[str], Tuple[float, str, int]],
+        prompt: str,
+        context_limit: int) -> List[PlannedRequest]:
+    """Turn the annotated sections of a decision into the fewest requests that fit the context window.
+
+    Adjacent small sections are packed into one request when their classes use the same
+    temperature and instruction (parameters_for). Sections that do not fit in the context
+    window together with the prompt and the output budget are split at sentence boundaries.
+    """
+    importance = {info['name']: info.get('importance', 0) for info in annotation_mappings.values()}
+    max_importance = max(importance.values(), default=0)
+    prompt_tokens = token_estimator.estimate(prompt) + MESSAGE_OVERHEAD_TOKENS
+
+    requests: List[PlannedRequest] = []
+    pack: List[Tuple[int, str, str, int]] = []  # (index, class name, text, tokens)
+
+    def flush_pack():
+        if not pack:
+            return
+        tokens = sum(item[3] for item in pack)
+        # The most important class of the pack sets its output budget
+        class_name = max((item[1] for item in pack), key=lambda name: importance.get(name, 0))
+        requests.append(PlannedRequest(
+            tuple(item[0] for item in pack), class_name, '\n\n'.join(item[2] for item in pack), tokens,
+            output_budget(importance.get(class_name, 0), max_importance, tokens),
+        ))
+        pack.clear()
+
+    for idx, section in enumerate(sections):
+        class_name = class_name_of(section, annotation_mappings)
+        text = section['text']
+        tokens = token_estimator.estimate(text)
+        temperature, content, _ = parameters_for(class_name)
+
+        if tokens < SMALL_SECTION_TOKENS:
+            packed_tokens = sum(item[3] for item in pack)
+            if pack and (parameters_for(pack[-1][1])[:2] != (temperature, content) or packed_tokens + tokens > PACK_TOKENS):
+                flush_pack()
+            pack.append((idx, class_name, text, tokens))
+            continue
+        flush_pack()
+
+        max_tokens = output_budget(importance.get(class_name, 0), max_importance, tokens)
+        max_input_tokens = context_limit - prompt_tokens - token_estimator.estimate(content) - max_tokens
+        if tokens <= max_input_tokens:
+            requests.append(PlannedRequest((idx,), class_name, text, tokens, max_tokens))
+            continue
+        for chunk in plan_chunks(text, max_input_tokens, token_estimator):
+            requests.append(PlannedRequest(
+                (idx,), class_name, text[chunk.start:chunk.end], chunk.tokens,
+                output_budget(importance.get(class_name, 0), max_importance, chunk.tokens),
+            ))
+    flush_pack()
+    return requests
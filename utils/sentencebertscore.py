@@ -1,13 +1,103 @@
-from sentence_transformers import SentenceTransformer, util
-import os 
+from functools import lru_cache
+from typing import List, Tuple
+from utils.lexical_metrics import METRICS, score_corpus
+import numpy as np
+import hashlib
+import csv
+import tempfile
+import os
 
-def evaluate_with_sbert(reference_summary, candidate_summary, model_name='paraphrase-MiniLM-L6-v2'):
-    model = SentenceTransformer(model_name)
-    reference_embedding = model.encode(reference_summary, convert_to_tensor=True)
-    candidate_embedding = model.encode(candidate_summary, convert_to_tensor=True)
+DEFAULT_MODEL = 'paraphrase-MiniLM-L6-v2'
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMBEDDING_CACHE_DIR = os.path.join(BASE_DIR, ".cache", "embeddings")
+# Candidate systems: name -> folder of documents/ with one summary per decision
+CANDIDATE_SYSTEMS = {"plain": "plain_summaries", "my": "my_summaries"}
+
+
+@lru_cache(maxsize=None)
+def load_model(model_name=DEFAULT_MODEL):
+    # sentence_transformers pulls in torch, so it is only imported when a model is needed
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+def evaluate_with_sbert(reference_summary, candidate_summary, model_name=DEFAULT_MODEL):
+    from sentence_transformers import util
+    model = load_model(model_name)
+    reference_embedding, candidate_embedding = model.encode([reference_summary, candidate_summary], convert_to_tensor=True)
     similarity_score = util.cos_sim(reference_embedding, candidate_embedding).item()
     return similarity_score
 
+
+class SbertEvaluator:
+    """Loads the SBERT model once and encodes summaries in batches.
+
+    Embeddings are normalized and cached on disk as .npy files keyed by the
+    SHA-256 of the text, in one folder per model, so only new or changed
+    summaries are encoded again.
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL, cache_dir=EMBEDDING_CACHE_DIR, batch_size=32):
+        self.model_name = model_name
+        self.cache_dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+        self.batch_size = batch_size
+        self.encoded = 0
+        self._model = None
+
+    @property
+    def model(self):
+        # The model is only needed when something is missing from the cache
+        if self._model is None:
+            self._model = load_model(self.model_name)
+        return self._model
+
+    def _cache_path(self, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.npy")
+
+    def _save(self, path: str, embedding: np.ndarray) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            np.save(file, embedding)
+        os.replace(tmp_path, path)
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """Return an (n, dim) array of L2-normalized embeddings, encoding only uncached texts."""
+        paths = [self._cache_path(text) for text in texts]
+        embeddings = [np.load(path) if os.path.exists(path) else None for path in paths]
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+
+        if missing:
+            encoded = self.model.encode(
+                [texts[idx] for idx in missing],
+                batch_size=self.batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+            )
+            for idx, embedding in zip(missing, encoded):
+                embedding = embedding.astype(np.float32)
+                self._save(paths[idx], embedding)
+                embeddings[idx] = embedding
+            self.encoded += len(missing)
+
+        if not embeddings:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.vstack(embeddings)
+
+    def embed_files(self, file_paths: List[str]) -> np.ndarray:
+        return self.embed_texts([read_summary_from_file(path) for path in file_paths])
+
+    @staticmethod
+    def similarity_matrix(reference_embeddings: np.ndarray, candidate_embeddings: np.ndarray) -> np.ndarray:
+        """Cosine similarity of every reference against every candidate (embeddings are normalized)."""
+        return reference_embeddings @ candidate_embeddings.T
+
+    @staticmethod
+    def paired_similarity(reference_embeddings: np.ndarray, candidate_embeddings: np.ndarray) -> np.ndarray:
+        """Cosine similarity of reference i with candidate i, without building the full matrix."""
+        return np.einsum("ij,ij->i", reference_embeddings, candidate_embeddings)
+
+
 def measure_length(summary):
     return len(summary.split())
 
@@ -17,60 +107,76 @@ def read_summary_from_file(file_path: str) -> str:
     with open(file_path, "r", encoding="utf-8") as file:
         return file.read()
 
-def main():
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+def write_results_table(results_file_path: str, rows: List[Tuple[str, str, str, float]]) -> None:
+    """Write one (decision, system, metric, value) row per score as CSV."""
+    with open(results_file_path, "w", encoding="utf-8", newline="") as results_file:
+        writer = csv.writer(results_file)
+        writer.writerow(["decision", "system", "metric", "value"])
+        for decision_number, system, metric, value in rows:
+            # Counts such as words are written as integers, scores with four decimals
+            writer.writerow([decision_number, system, metric, value if isinstance(value, int) else f"{value:.4f}"])
+
+def main(workers=None):
+    base_dir = BASE_DIR
     reference_folder = os.path.join(base_dir, "documents", "ste_summaries")
-    candidate_folder_plain = os.path.join(base_dir, "documents", "plain_summaries")
-    candidate_folder_my = os.path.join(base_dir, "documents", "my_summaries")
-    results_file_path = os.path.join(base_dir, "results.txt")
-
-    decision_numbers = ["ste_1412-2024", "ste_1508-2024", "ste_1537-2023", "ste_2221-2023", "ste_2325-2023"]
-
-    total_similarity_plain = 0
-    total_similarity_my = 0
-    count = 0
-
-    with open(results_file_path, "w", encoding="utf-8") as results_file:
-        for decision_number in decision_numbers:
-            print(f"Processing decision: {decision_number}")
-            
-            reference_file_path = os.path.join(reference_folder, f"{decision_number}.txt")
-            candidate_file_path_plain = os.path.join(candidate_folder_plain, f"{decision_number}.txt")
-            candidate_file_path_my = os.path.join(candidate_folder_my, f"{decision_number}.txt")
-
-            try:
-                reference_summary = read_summary_from_file(reference_file_path)
-                candidate_summary_plain = read_summary_from_file(candidate_file_path_plain)
-                candidate_summary_my = read_summary_from_file(candidate_file_path_my)
-            
-                # Evaluate similarity 
-                similarity_score_plain = evaluate_with_sbert(reference_summary, candidate_summary_plain)
-                similarity_score_my = evaluate_with_sbert(reference_summary, candidate_summary_my)
-                
-                total_similarity_plain += similarity_score_plain
-                total_similarity_my += similarity_score_my
-                count += 1
-                
-                results_file.write(f"{decision_number}: PLAIN {similarity_score_plain:.4f}, MY {similarity_score_my:.4f}\n")
-                
-                print(f"Semantic Similarity Score (SBERT) PLAIN: {similarity_score_plain:.4f}")
-                print(f"Semantic Similarity Score (SBERT) MY: {similarity_score_my:.4f}")
-                
-                # Print length
-                plain_length = measure_length(candidate_summary_plain)
-                my_length = measure_length(candidate_summary_my)
-                print(f"PLAIN Summary Length: {plain_length} words")
-                print(f"MY Summary Length: {my_length} words")
-                print("-")
-            
-            except FileNotFoundError as e:
-                print(e)
-
-        if count > 0:
-            avg_similarity_plain = total_similarity_plain / count
-            avg_similarity_my = total_similarity_my / count
-            results_file.write(f"\nCollective Scores - PLAIN: {avg_similarity_plain:.4f}, MY: {avg_similarity_my:.4f}\n")
-            print(f"Collective Scores - PLAIN: {avg_similarity_plain:.4f}, MY: {avg_similarity_my:.4f}")
+    results_file_path = os.path.join(base_dir, "results.csv")
+
+    # Read every summary first, so that all of them are encoded in a single batch
+    decisions, references, candidates = [], [], {system: [] for system in CANDIDATE_SYSTEMS}
+    for decision_number in sorted(os.path.splitext(name)[0] for name in os.listdir(reference_folder)):
+        try:
+            reference_summary = read_summary_from_file(os.path.join(reference_folder, f"{decision_number}.txt"))
+            candidate_summaries = {
+                system: read_summary_from_file(os.path.join(base_dir, "documents", folder, f"{decision_number}.txt"))
+                for system, folder in CANDIDATE_SYSTEMS.items()
+            }
+        except FileNotFoundError as e:
+            print(e)
+            continue
+        decisions.append(decision_number)
+        references.append(reference_summary)
+        for system, summary in candidate_summaries.items():
+            candidates[system].append(summary)
+
+    count = len(decisions)
+    if count == 0:
+        print("No decisions to evaluate")
+        return
+
+    evaluator = SbertEvaluator()
+    embeddings = evaluator.embed_texts(references + [summary for system in CANDIDATE_SYSTEMS for summary in candidates[system]])
+    print(f"Encoded {evaluator.encoded} summaries, {len(embeddings) - evaluator.encoded} from cache")
+    # Reference i is compared with candidate i of every system
+    sbert = {
+        system: evaluator.paired_similarity(embeddings[:count], embeddings[(offset + 1) * count:(offset + 2) * count])
+        for offset, system in enumerate(CANDIDATE_SYSTEMS)
+    }
+
+    lexical = score_corpus(
+        [(decision_number, references[idx], {system: candidates[system][idx] for system in CANDIDATE_SYSTEMS})
+         for idx, decision_number in enumerate(decisions)],
+        workers,
+    )
+
+    rows = []
+    for idx, decision_number in enumerate(decisions):
+        for system in CANDIDATE_SYSTEMS:
+            rows.append((decision_number, system, "sbert", float(sbert[system][idx])))
+            rows.extend((decision_number, system, metric, lexical[decision_number][system][metric]) for metric in METRICS)
+            rows.append((decision_number, system, "words", measure_length(candidates[system][idx])))
+
+    # Collective scores: mean of every (system, metric) over the decisions
+    collective = {}
+    for _, system, metric, value in rows:
+        collective.setdefault((system, metric), []).append(value)
+    rows.extend(("collective", system, metric, float(np.mean(values))) for (system, metric), values in collective.items())
+    write_results_table(results_file_path, rows)
+
+    metrics = ("sbert",) + METRICS + ("words",)
+    print(f"{'system':<8}" + "".join(f"{metric:>10}" for metric in metrics))
+    for system in CANDIDATE_SYSTEMS:
+        print(f"{system:<8}" + "".join(f"{np.mean(collective[(system, metric)]):>10.4f}" for metric in metrics))
+    print(f"Results of {count} decisions saved to {results_file_path}")
 
 if __name__ == "__main__":
     main()
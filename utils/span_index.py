@@ -0,0 +1,215 @@
+"""Compact storage for annotated decisions.
+
+A ``.spans`` file keeps only the (class, start, end) offsets of every annotation into
+the source text of ``documents/txt_files`` instead of a second copy of the text:
+
+    b'CDSPANS1' | header length (uint32) | JSON header | records ('<u2 class, <u4 start, <u4 end')
+
+Offsets are UTF-8 byte offsets, so the reader can memory-map the text file and decode
+a section only when it is accessed. Sections whose text cannot be found in the source
+file (edited by hand while annotating) are kept verbatim in the header. The header keeps
+the SHA-256 of the source file; an index whose source file changed is rebuilt from the
+annotated JSON when it is loaded, since its offsets would cut the sections at random.
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+from os.path import join, splitext
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from utils.normalizer import normalize_text, vocabulary_of
+
+MAGIC = b'CDSPANS1'
+RECORD = np.dtype([('class_index', '<u2'), ('start', '<u4'), ('end', '<u4')])
+INLINE = 0xFFFFFFFF  # start value of a section kept verbatim in the header
+
+ANNOTATED_FOLDER = join('documents', 'annotated_decisions')
+TXT_FOLDER = join('documents', 'txt_files')
+SPAN_FOLDER = join('documents', 'span_index')
+HEADER_FIELDS = ('document_id', 'court', 'legal_remedy', 'related_department')
+ANCHOR_LENGTH = 40
+
+
+class StaleSpanIndexError(ValueError):
+    """The source text file changed after the .spans file was written."""
+
+
+def align_sections(text: str, section_texts: List[str]) -> List[Optional[Tuple[int, int]]]:
+    """Find the character span of every section in text, in document order.
+
+    Both texts are compared after layout normalization (utils/normalizer.py, with one
+    space between paragraphs), so whitespace, line-break hyphenation and letter-spaced
+    words do not matter; the offset map of the normalized text gives the original span.
+    When the exact section is not found, its first and last ANCHOR_LENGTH characters are
+    searched and accepted if the distance between them is close to the section length.
+    None marks sections that cannot be found.
+    """
+    vocabulary = vocabulary_of([text])
+    document = normalize_text(text, vocabulary, paragraph_break=' ')
+    collapsed = document.text
+    spans, cursor = [], 0
+    for section_text in section_texts:
+        needle = normalize_text(section_text, vocabulary, paragraph_break=' ').text
+        if not needle:
+            spans.append(None)
+            continue
+        start = collapsed.find(needle, cursor)
+        end = start + len(needle)
+        if start < 0 and len(needle) > 2 * ANCHOR_LENGTH:
+            start = collapsed.find(needle[:ANCHOR_LENGTH], cursor)
+            tail = collapsed.find(needle[-ANCHOR_LENGTH:], start + len(needle) * 9 // 10 - ANCHOR_LENGTH) if start >= 0 else -1
+            end = tail + ANCHOR_LENGTH
+            if tail < 0 or abs((end - start) - len(needle)) > max(20, len(needle) // 20):
+                start = -1
+        if start < 0:
+            spans.append(None)
+            continue
+        spans.append(document.original_span(start, end))
+        cursor = end
+    return spans
+
+
+def convert_annotated_decision(annotated_path: str, text_path: str, output_path: str) -> int:
+    """Write the .spans file of an annotated decision. Returns the number of inline sections."""
+    with open(annotated_path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    with open(text_path, 'rb') as file:
+        raw = file.read()
+    text = raw.decode('utf-8')
+
+    annotations = data.get('annotations', [])
+    spans = align_sections(text, [annotation['text'] for annotation in annotations])
+    # Character -> byte offsets of the UTF-8 file
+    byte_offsets = np.zeros(len(text) + 1, dtype=np.int64)
+    byte_offsets[1:] = np.cumsum([len(char.encode('utf-8')) for char in text])
+
+    classes, inline = [], []
+    records = np.zeros(len(annotations), dtype=RECORD)
+    for idx, (annotation, span) in enumerate(zip(annotations, spans)):
+        if annotation['class_id'] not in classes:
+            classes.append(annotation['class_id'])
+        records[idx]['class_index'] = classes.index(annotation['class_id'])
+        if span is None:
+            records[idx]['start'], records[idx]['end'] = INLINE, len(inline)
+            inline.append(annotation['text'])
+        else:
+            records[idx]['start'], records[idx]['end'] = byte_offsets[span[0]], byte_offsets[span[1]]
+
+    header = {field: data.get(field, '') for field in HEADER_FIELDS}
+    header.update({
+        'text_file': os.path.basename(text_path),
+        'text_sha256': hashlib.sha256(raw).hexdigest(),
+        'classes': classes,
+        'inline': inline,
+    })
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(struct.pack('<I', len(header_bytes)))
+        file.write(header_bytes)
+        file.write(records.tobytes())
+    os.replace(tmp_path, output_path)
+    return len(inline)
+
+
+class SpanDecision:
+    """Read-only view of a .spans file.
+
+    Behaves like the 'annotations' list of the JSON format: indexing or iterating
+    yields {'class_id', 'text'} dicts, and the text of a section is only decoded
+    from the memory-mapped source file when that section is accessed.
+    """
+
+    def __init__(self, span_path: str, text_folder: str = TXT_FOLDER) -> None:
+        with open(span_path, 'rb') as file:
+            data = file.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{span_path} is not a span index file')
+        header_length, = struct.unpack_from('<I', data, len(MAGIC))
+        header_end = len(MAGIC) + 4 + header_length
+        self.header = json.loads(data[len(MAGIC) + 4:header_end].decode('utf-8'))
+        self.records = np.frombuffer(data, dtype=RECORD, offset=header_end)
+
+        self._text_file = open(join(text_folder, self.header['text_file']), 'rb')
+        self._text = mmap.mmap(self._text_file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self._text_file.name) else b''
+        if hashlib.sha256(self._text).hexdigest() != self.header['text_sha256']:
+            self.close()
+            raise StaleSpanIndexError(f"{self.header['text_file']} changed after {span_path} was written")
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        class_index, start, end = self.records[idx].tolist()
+        if start == INLINE:
+            text = self.header['inline'][end]
+        else:
+            text = self._text[start:end].decode('utf-8')
+        return {'class_id': self.header['classes'][class_index], 'text': text}
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return (self[idx] for idx in range(len(self)))
+
+    @property
+    def text(self) -> str:
+        return self._text[:].decode('utf-8')
+
+    def close(self) -> None:
+        if isinstance(self._text, mmap.mmap):
+            self._text.close()
+        self._text_file.close()
+
+    def __enter__(self) -> 'SpanDecision':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def load_annotated_decision(decision_number: str) -> Dict[str, Any]:
+    """Annotated decision from the span index if it exists, otherwise from its JSON file."""
+    span_path = join(SPAN_FOLDER, f'{decision_number}.spans')
+    annotated_path = join(ANNOTATED_FOLDER, f'{decision_number}.json')
+    if os.path.exists(span_path):
+        try:
+            sections = SpanDecision(span_path)
+        except StaleSpanIndexError as e:
+            if not os.path.exists(annotated_path):
+                raise
+            print(f'{e}; rebuilding it')
+            convert_annotated_decision(annotated_path, join(TXT_FOLDER, f'{decision_number}.txt'), span_path)
+            sections = SpanDecision(span_path)
+        return {**{field: sections.header.get(field, '') for field in HEADER_FIELDS}, 'annotations': sections}
+    with open(annotated_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert annotated decisions to the span index format.')
+    parser.add_argument('decisions', nargs='*', help='decision numbers (default: every annotated decision)')
+    args = parser.parse_args()
+
+    decisions = args.decisions or sorted(
+        splitext(name)[0] for name in os.listdir(ANNOTATED_FOLDER) if name.endswith('.json')
+    )
+    for decision_number in decisions:
+        annotated_path = join(ANNOTATED_FOLDER, f'{decision_number}.json')
+        text_path = join(TXT_FOLDER, f'{decision_number}.txt')
+        if not os.path.exists(text_path):
+            print(f'{decision_number}: skipped, {text_path} does not exist')
+            continue
+        output_path = join(SPAN_FOLDER, f'{decision_number}.spans')
+        inline = convert_annotated_decision(annotated_path, text_path, output_path)
+        print(f'{decision_number}: {os.path.getsize(annotated_path)} -> {os.path.getsize(output_path)} bytes, {inline} inline sections')
+
+
+if __name__ == '__main__':
+    main()
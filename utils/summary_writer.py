@@ -0,0 +1,38 @@
+import os
+
+
+class IncrementalSummaryWriter:
+    """Appends summaries to a partial output file as soon as they arrive.
+
+    Summaries are written in document order: one that finishes before its predecessors
+    is held back until they are written. If the run fails later on, the partial file
+    keeps everything summarized so far.
+    """
+
+    def __init__(self, path: str, separator: str = '\n\n') -> None:
+        self.path = path
+        self.separator = separator
+        self.pending = {}
+        self.next_idx = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        open(path, 'w', encoding='utf-8').close()
+
+    def add(self, idx: int, summary: str) -> None:
+        """Register the summary of part idx (0-based) and flush every part that is now in order."""
+        self.pending[idx] = summary
+        while self.next_idx in self.pending:
+            self.append(self.pending.pop(self.next_idx))
+            self.next_idx += 1
+
+    def append(self, summary: str) -> None:
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(summary + self.separator)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def discard(self) -> None:
+        """Remove the partial file once the final summary has been written."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
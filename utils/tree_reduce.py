@@ -0,0 +1,126 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from utils.chunking import TokenEstimator, plan_chunks
+
+DEFAULT_MAX_WORKERS = 8
+SHRINK_RATIO = 0.8  # a level that keeps this share of its input tokens or more is the last one
+
+
+def parallel_map(summarize: Callable[[str], str], texts: Sequence[str], max_workers: int = DEFAULT_MAX_WORKERS) -> Iterator[str]:
+    """Summarize texts on a thread pool and yield the summaries in input order."""
+    if len(texts) <= 1 or max_workers <= 1:
+        yield from map(summarize, texts)
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(texts))) as executor:
+        yield from executor.map(summarize, texts)
+
+
+def iter_groups(pieces: Iterable[Tuple[str, int]], max_group_tokens: int, token_estimator: TokenEstimator) -> Iterator[Tuple[str, int]]:
+    """Join adjacent (text, tokens) pieces into groups of at most max_group_tokens; texts larger than that are split.
+
+    Every group is yielded with its token count as soon as the next piece does not fit in it,
+    so the groups can be sent before the rest of the pieces is known.
+    """
+    current, current_tokens = [], 0
+    for text, tokens in pieces:
+        if tokens > max_group_tokens:
+            parts = [(text[chunk.start:chunk.end], chunk.tokens) for chunk in plan_chunks(text, max_group_tokens, token_estimator)]
+        else:
+            parts = [(text, tokens)]
+        for part, part_tokens in parts:
+            if current and current_tokens + part_tokens > max_group_tokens:
+                yield '\n\n'.join(current), current_tokens
+                current, current_tokens = [], 0
+            current.append(part)
+            current_tokens += part_tokens
+    if current:
+        yield '\n\n'.join(current), current_tokens
+
+
+def group_adjacent(texts: Sequence[str], token_counts: Sequence[int], max_group_tokens: int, token_estimator: TokenEstimator) -> List[str]:
+    """Join adjacent texts into groups of at most max_group_tokens; texts larger than that are split."""
+    return [group for group, _ in iter_groups(zip(texts, token_counts), max_group_tokens, token_estimator)]
+
+
+def needs_another_level(tokens: int, input_tokens: Optional[int], max_total_tokens: int, shrink_ratio: float = SHRINK_RATIO) -> bool:
+    """Whether summaries of tokens tokens, summarizing input_tokens tokens (None for the original summaries), are reduced again."""
+    return tokens > max_total_tokens and (input_tokens is None or tokens < shrink_ratio * input_tokens)
+
+
+def _answered(summary: str) -> Future:
+    future = Future()
+    future.set_result(summary)
+    return future
+
+
+class _Level:
+    """The summaries of one reduce level, read in document order as their requests are answered."""
+
+    def __init__(self, items: List[Tuple[Future, Optional[int]]]) -> None:
+        self.items = items  # (summary, tokens of the group it summarizes or None for the original summaries)
+        self.summaries: List[str] = []
+        self.tokens = 0
+        self.input_tokens: Optional[int] = None
+
+    def answers(self, token_estimator: TokenEstimator) -> Iterator[Tuple[str, int]]:
+        for future, group_tokens in self.items:
+            summary = future.result()
+            tokens = token_estimator.estimate(summary)
+            self.summaries.append(summary)
+            self.tokens += tokens
+            if group_tokens is not None:
+                self.input_tokens = (self.input_tokens or 0) + group_tokens
+            yield summary, tokens
+
+
+def reduce_summaries(
+        summaries: Sequence[str],
+        summarize: Callable[[str], str],
+        token_estimator: TokenEstimator,
+        max_group_tokens: int,
+        max_total_tokens: int,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        shrink_ratio: float = SHRINK_RATIO) -> List[str]:
+    """Hierarchically summarize summaries until together they fit in max_total_tokens.
+
+    Every level joins adjacent summaries into groups of at most max_group_tokens and
+    summarizes the groups in parallel, so the number of levels grows with the logarithm
+    of the input size. The levels are pipelined: a group of the next level is sent as soon
+    as the summaries it joins are answered, once the answered part of the level already
+    exceeds max_total_tokens and has shrunk below shrink_ratio of its input. A level that
+    keeps shrink_ratio or more of its input tokens is the last one, and the requests already
+    sent for the level after it are cancelled. Nothing is truncated or dropped; a level that
+    did not shrink the text at all is discarded in favour of the level before it.
+    """
+    level = _Level([(_answered(summary), None) for summary in summaries])
+    previous = list(summaries)
+    number = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        while True:
+            next_items, waiting = [], []
+            for group in iter_groups(level.answers(token_estimator), max_group_tokens, token_estimator):
+                waiting.append(group)
+                if next_items or needs_another_level(level.tokens, level.input_tokens, max_total_tokens, shrink_ratio):
+                    next_items.extend((executor.submit(summarize, text), tokens) for text, tokens in waiting)
+                    waiting = []
+            if number:
+                print(f'Reduce level {number}: {len(previous)} summaries ({level.input_tokens} tokens) -> '
+                      f'{len(level.summaries)} summaries ({level.tokens} tokens)')
+            if not needs_another_level(level.tokens, level.input_tokens, max_total_tokens, shrink_ratio):
+                for future, _ in next_items:
+                    future.cancel()
+                if level.input_tokens is None or level.tokens <= max_total_tokens:
+                    return level.summaries
+                if level.tokens >= level.input_tokens:
+                    print(f'Reduce level {number} did not shrink the summaries, stopping')
+                    return previous
+                print(f'Reduce level {number} kept more than {shrink_ratio:.0%} of the tokens, stopping')
+                return level.summaries
+            next_items.extend((executor.submit(summarize, text), tokens) for text, tokens in waiting)
+            previous, level = level.summaries, _Level(next_items)
+            number += 1
+    finally:
+        # Requests of a level that is not needed any more are not waited for
+        executor.shutdown(wait=False, cancel_futures=True)
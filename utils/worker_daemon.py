@@ -0,0 +1,220 @@
+"""Resident worker that keeps the expensive objects of the pipelines loaded between jobs.
+
+Starting a pipeline costs more than a small job: importing openai, building the tiktoken
+encodings and loading the SBERT model (torch) take seconds. ``serve`` loads them once and
+answers jobs on a Unix socket; the client side of this module imports only the standard
+library, so sending a job starts instantly:
+
+    python -m utils.worker_daemon serve &
+    python -m utils.worker_daemon summarize structured ste_2325-2023
+    python -m utils.worker_daemon score documents/ste_summaries/ste_2325-2023.txt documents/my_summaries/ste_2325-2023.txt
+    python -m utils.worker_daemon stop
+
+Every job and every reply is one JSON line. Jobs run one at a time, because the pipelines
+print their progress and share the metrics labels; the printed output is sent back with
+the reply, which looks like a record of batch.py (status, error, traceback, elapsed).
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from os.path import join
+from typing import Any, Dict
+
+SOCKET_PATH = os.getenv('WORKER_SOCKET', join('.cache', 'worker.sock'))
+PIPELINES = ('structured', 'plain')
+ENCODING_MODELS = ('gpt-4', 'gpt-3.5-turbo')  # TokenEstimator models of main.py and plain_summary.py
+
+
+class Worker:
+    """The warm state and the jobs that use it."""
+
+    def __init__(self, load_sbert: bool = True) -> None:
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.jobs = 0
+        self.warm_up(load_sbert)
+
+    def warm_up(self, load_sbert: bool) -> None:
+        started = time.perf_counter()
+        import openai
+        import main
+        import plain_summary
+        from utils.chunking import get_encoding
+        for model in ENCODING_MODELS:
+            get_encoding(model)
+        try:
+            main.get_client()
+            plain_summary.get_client()
+        except openai.OpenAIError as e:  # e.g. no OPENAI_KEY
+            print(f'No OpenAI client, summarize jobs will fail: {e}', flush=True)
+        self.evaluator = None
+        if load_sbert:
+            from utils.sentencebertscore import SbertEvaluator, load_model
+            load_model()
+            self.evaluator = SbertEvaluator()
+        print(f'Worker ready in {time.perf_counter() - started:.1f}s', flush=True)
+
+    def summarize(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        if job['pipeline'] == 'structured':
+            import main
+            main.summarize_decision(job['decision'])
+        else:
+            import plain_summary
+            plain_summary.summarize_large_text(
+                job['decision'], plain_summary.INPUT_FOLDER, plain_summary.OUTPUT_FOLDER, plain_summary.PROMPT
+            )
+        return {}
+
+    def score(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """SBERT similarity of every reference with the candidate at the same position."""
+        if self.evaluator is None:
+            from utils.sentencebertscore import SbertEvaluator
+            self.evaluator = SbertEvaluator()
+        references, candidates = job['references'], job['candidates']
+        embeddings = self.evaluator.embed_texts(references + candidates)
+        scores = self.evaluator.paired_similarity(embeddings[:len(references)], embeddings[len(references):])
+        return {'scores': [float(score) for score in scores]}
+
+    def stats(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        from utils.metrics import default_recorder
+        return {'pid': os.getpid(), 'uptime': round(time.time() - self.started, 1), 'jobs': self.jobs,
+                'usage': default_recorder().summary()}
+
+    def run(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """Run one job. Never raises: failures are reported in the reply."""
+        handler = {'summarize': self.summarize, 'score': self.score, 'stats': self.stats}.get(job.get('type'))
+        if handler is None:
+            return {'status': 'failed', 'error': f"unknown job type {job.get('type')!r}"}
+        started = time.time()
+        output = io.StringIO()
+        with self.lock, contextlib.redirect_stdout(output):
+            self.jobs += 1
+            try:
+                reply = {'status': 'done', **handler(job)}
+            except Exception as e:
+                reply = {'status': 'failed', 'error': f'{type(e).__name__}: {e}', 'traceback': traceback.format_exc()}
+        reply['output'] = output.getvalue()
+        reply['elapsed'] = round(time.time() - started, 3)
+        return reply
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            job = json.loads(line)
+            if job.get('type') == 'shutdown':
+                self._reply({'status': 'done'})
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            self._reply(self.server.worker.run(job))
+
+    def _reply(self, reply: Dict[str, Any]) -> None:
+        self.wfile.write((json.dumps(reply, ensure_ascii=False) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+
+class WorkerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, worker: Worker) -> None:
+        self.worker = worker
+        super().__init__(socket_path, _Handler)
+
+
+def serve(socket_path: str = SOCKET_PATH, load_sbert: bool = True) -> None:
+    if not hasattr(socket, 'AF_UNIX'):
+        raise OSError('The worker needs Unix domain sockets, which this platform does not support')
+    if os.path.exists(socket_path):
+        try:
+            send({'type': 'stats'}, socket_path)
+            raise OSError(f'A worker is already listening on {socket_path}')
+        except ConnectionRefusedError:
+            os.remove(socket_path)  # left behind by a worker that did not exit cleanly
+    os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+    worker = Worker(load_sbert)
+    with WorkerServer(socket_path, worker) as server:
+        print(f'Listening on {socket_path}', flush=True)
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def send(job: Dict[str, Any], socket_path: str = SOCKET_PATH) -> Dict[str, Any]:
+    """Send one job to the worker and wait for its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps(job, ensure_ascii=False) + '\n').encode('utf-8'))
+        with connection.makefile('rb') as replies:
+            line = replies.readline()
+    if not line:
+        raise ConnectionError(f'The worker on {socket_path} closed the connection without a reply')
+    return json.loads(line)
+
+
+def summarize(decision_number: str, pipeline: str = 'structured', socket_path: str = SOCKET_PATH) -> Dict[str, Any]:
+    return send({'type': 'summarize', 'pipeline': pipeline, 'decision': decision_number}, socket_path)
+
+
+def score(references, candidates, socket_path: str = SOCKET_PATH) -> Dict[str, Any]:
+    return send({'type': 'score', 'references': list(references), 'candidates': list(candidates)}, socket_path)
+
+
+def _read(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as file:
+        return file.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run summarize and score jobs in a warm worker process.')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='Unix socket of the worker (default: $WORKER_SOCKET or %(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='start the worker and load the models')
+    serve_parser.add_argument('--no-sbert', action='store_true', help='load the SBERT model on the first score job instead')
+    summarize_parser = subparsers.add_parser('summarize', help='summarize decisions')
+    summarize_parser.add_argument('pipeline', choices=PIPELINES)
+    summarize_parser.add_argument('decisions', nargs='+')
+    score_parser = subparsers.add_parser('score', help='SBERT similarity of a reference and a candidate summary')
+    score_parser.add_argument('reference')
+    score_parser.add_argument('candidate')
+    subparsers.add_parser('stats', help='uptime, jobs and API usage of the worker')
+    subparsers.add_parser('stop', help='stop the worker')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.socket, not args.no_sbert)
+        return
+    texts = (_read(args.reference), _read(args.candidate)) if args.command == 'score' else None
+    try:
+        if args.command == 'stop':
+            send({'type': 'shutdown'}, args.socket)
+            return
+        if args.command == 'summarize':
+            replies = [summarize(decision, args.pipeline, args.socket) for decision in args.decisions]
+        elif args.command == 'score':
+            replies = [score([texts[0]], [texts[1]], args.socket)]
+        else:
+            replies = [send({'type': 'stats'}, args.socket)]
+    except (FileNotFoundError, ConnectionRefusedError):
+        sys.exit(f'No worker is listening on {args.socket}; start one with: python -m utils.worker_daemon serve')
+
+    failed = False
+    for reply in replies:
+        sys.stdout.write(reply.pop('output', ''))
+        if reply['status'] == 'failed':
+            failed = True
+            print(reply.get('traceback') or reply['error'], file=sys.stderr)
+        print(json.dumps({key: value for key, value in reply.items() if key != 'traceback'}, ensure_ascii=False))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()